@@ -113,6 +113,8 @@ def setup_server():
     # Install required system packages for deployment, plus some extras
     # Install pip, and use it to install virtualenv
     install_packages()
+    # The monitor processes share their configuration cache through memcached (see CACHES in settings.py)
+    memcached_restart()
     sudo("easy_install -U pip")
     sudo("pip install -U virtualenv")
     upgrade_packages()
@@ -147,7 +149,7 @@ def bootstrap():
 def create_virtualenv():
     """ setup virtualenv on remote host """
     require('virtualenv_root', provided_by=('staging', 'production'))
-    args = '--clear --distribute --no-site-packages'
+    args = '--clear --distribute --no-site-packages --python=python2.7'
     sudo('virtualenv %s %s' % (args, env.virtualenv_root), user=env.sudo_user)
 
 
@@ -232,6 +234,12 @@ def apache_restart():
     run('sudo /etc/init.d/apache2 restart')
 
 
+def memcached_restart():
+    """ restart memcached on remote host """
+    require('root', provided_by=('staging', 'production'))
+    run('sudo /etc/init.d/memcached restart')
+
+
 def netstat_plnt():
     """ run netstat -plnt on a remote host """
     require('hosts', provided_by=('production', 'staging'))
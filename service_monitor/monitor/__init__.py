@@ -0,0 +1,4 @@
+# Connects the signals which keep the cached service configuration in
+# step with every save and delete of a Service (see config.py), in every
+# process which loads the app, including the admin
+from . import config
@@ -0,0 +1,109 @@
+import datetime
+import threading
+
+from collections import deque
+from .models import *
+from django.conf import settings
+
+# A service is alerted on once this many of its last
+# SERVICE_MONITOR_ALERT_WINDOW pings have failed
+SERVICE_MONITOR_ALERT_FAILURES = getattr(settings, "SERVICE_MONITOR_ALERT_FAILURES", 2)
+
+# The number of most recent pings of each service which are considered
+SERVICE_MONITOR_ALERT_WINDOW = getattr(settings, "SERVICE_MONITOR_ALERT_WINDOW", 3)
+
+# The number of consecutive successful pings after which an alerted
+# service is considered to have recovered
+SERVICE_MONITOR_RECOVERY_SUCCESSES = getattr(settings, "SERVICE_MONITOR_RECOVERY_SUCCESSES", 2)
+
+# How often the alert is repeated while a service keeps failing (None to
+# alert only once)
+SERVICE_MONITOR_REALERT_MINUTES = getattr(settings, "SERVICE_MONITOR_REALERT_MINUTES", 60)
+
+# What observe() returns when a notification should be sent
+ALERT = "alert"
+REALERT = "realert"
+RECOVERED = "recovered"
+
+# The ping states which count as a failed ping
+FAILED_STATES = (SERVICE_MONITOR__NO_RESPONSE, SERVICE_MONITOR__INVALID_RESPONSE_RECEIVED)
+
+"""
+Decides when a failing service is worth a notification, from the
+outcomes of its most recent pings kept in memory.
+
+A service is alerted on once SERVICE_MONITOR_ALERT_FAILURES of its
+last SERVICE_MONITOR_ALERT_WINDOW pings have failed, so a single lost
+ping does not send an email. While it keeps failing the alert is only
+repeated every SERVICE_MONITOR_REALERT_MINUTES, and once it has
+succeeded SERVICE_MONITOR_RECOVERY_SUCCESSES times in a row a single
+"recovered" notification is sent, so a flapping service does not
+send an email on every change.
+"""
+class AlertTracker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.successes = {}
+        self.alerted_dates = {}
+
+    """
+    Starts tracking the given service from its saved state, if it is
+    not being tracked yet. A service which was left failing is assumed
+    to have been alerted on already. Must be called before its state
+    changes.
+    """
+    def seed(self, service):
+        self.lock.acquire()
+        try:
+            if service.pk not in self.alerted_dates:
+                if service.ping_state in FAILED_STATES:
+                    self.alerted_dates[service.pk] = datetime.datetime.now()
+                else:
+                    self.alerted_dates[service.pk] = None
+        finally:
+            self.lock.release()
+
+    """
+    Returns True if the given service is currently alerted on.
+    """
+    def is_alerting(self, service):
+        return self.alerted_dates.get(service.pk) is not None
+
+    """
+    Adds the outcome of a ping to the window of the given service.
+    Returns ALERT, REALERT or RECOVERED if a notification should be
+    sent, otherwise None.
+    """
+    def observe(self, service, failed, now=None):
+        now = now or datetime.datetime.now()
+        self.lock.acquire()
+        try:
+            window = self.windows.get(service.pk)
+            if window is None or window.maxlen != SERVICE_MONITOR_ALERT_WINDOW:
+                window = deque(window or [], SERVICE_MONITOR_ALERT_WINDOW)
+                self.windows[service.pk] = window
+            window.append(failed)
+            alerted_date = self.alerted_dates.get(service.pk)
+
+            if failed:
+                self.successes[service.pk] = 0
+                if alerted_date is None:
+                    if window.count(True) >= SERVICE_MONITOR_ALERT_FAILURES:
+                        self.alerted_dates[service.pk] = now
+                        return ALERT
+                elif SERVICE_MONITOR_REALERT_MINUTES is not None and now - alerted_date >= datetime.timedelta(minutes=SERVICE_MONITOR_REALERT_MINUTES):
+                    self.alerted_dates[service.pk] = now
+                    return REALERT
+            else:
+                self.successes[service.pk] = self.successes.get(service.pk, 0) + 1
+                if alerted_date is not None and self.successes[service.pk] >= SERVICE_MONITOR_RECOVERY_SUCCESSES:
+                    self.alerted_dates[service.pk] = None
+                    window.clear()
+                    return RECOVERED
+            return None
+        finally:
+            self.lock.release()
+
+# The tracker shared by everything running in this process
+alert_tracker = AlertTracker()
@@ -1,8 +1,11 @@
-from datetime import datetime
+import datetime
 import pytz
-import re
 
-from .tasks import send_notification_email
+from .tasks import send_notification_email, catch_up, requeue, start_probe_loop, SERVICE_MONITOR_PROBE_LOOP
+from .writer import writer
+from .probe import latency_tracker
+from .alerts import alert_tracker, REALERT, RECOVERED
+from .lookup import service_index
 from .models import *
 from rapidsms.apps.base import AppBase
 from scheduler.models import *
@@ -12,10 +15,19 @@ from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
 class App(AppBase):
     
     """
-    Upon starting the router, create an EventSchedule to do
-    the periodic pinging if it has not yet been created.
+    Upon starting the router, create the EventSchedules to do
+    the periodic pinging and the daily PingLog cleanup if they
+    have not yet been created, catch up on the SMS pings
+    missed while the router was down, queue again the SMS
+    requests which had not been sent yet, and start the probe
+    loop if it is used instead of the EventSchedule.
     """
     def start(self):
+        catch_up()
+        requeue()
+        if SERVICE_MONITOR_PROBE_LOOP:
+            start_probe_loop()
+        
         try:
             e = EventSchedule.objects.get(description="Service Monitor Schedule")
         except ObjectDoesNotExist:
@@ -25,37 +37,70 @@ class App(AppBase):
                ,minutes=ALL_VALUE
             )
             e.save()
+        
+        try:
+            e = EventSchedule.objects.get(description="Service Monitor Retention Schedule")
+        except ObjectDoesNotExist:
+            e = EventSchedule(
+                description="Service Monitor Retention Schedule"
+               ,callback="monitor.tasks.prune"
+               ,hours=set([3])
+               ,minutes=set([0])
+            )
+            e.save()
     
     """
     When a message comes in, lookup the service associated with
     the mobile number it was sent from and mark that service as
-    having responded.
+    having responded. The service and its compiled regular
+    expression come from the in-memory index (see lookup.py),
+    so only the state change is written. When several services
+    share the connection, the reply is matched to the request
+    whose correlation token it contains.
     """
     def handle(self, message):
         try:
-            # Get the regular expression which the response should match
-            service = Service.objects.get(connection__identity=message.connection.identity)
-            valid_response_regex = service.valid_response_regex
-            if (valid_response_regex is None) or (valid_response_regex == ""):
-                valid_response_regex = r"^(.+)$"
-            regex = re.compile(valid_response_regex)
+            # Get the service and the regular expression which the response should match
+            descriptor = service_index.match(message.connection.identity, message.text)
+            service = descriptor.service()
+            
+            # Measure the round trip from when this request was handed off to be sent, if known
+            current_date = datetime.datetime.now(tz=pytz.utc)
+            request_date = service_index.pop_sent_date(service.request_token) or service.last_request_date
+            latency_ms = milliseconds_between(request_date, current_date)
             
-            # Mark the service as having responded, either with a valid or invalid response
-            current_date = datetime.now(tz=pytz.utc)
+            # Mark the service as having responded, either with a valid (possibly too slow) or invalid response
+            was_degraded = is_degraded = False
+            alert_tracker.seed(service)
             service.last_response_date = current_date
-            if regex.match(message.text):
-                service.ping_state = SERVICE_MONITOR__VALID_RESPONSE_RECEIVED
+            if descriptor.regex.match(message.text):
+                was_degraded, is_degraded = latency_tracker.observe(service, latency_ms)
+                if is_degraded:
+                    service.ping_state = SERVICE_MONITOR__DEGRADED
+                else:
+                    service.ping_state = SERVICE_MONITOR__VALID_RESPONSE_RECEIVED
             else:
                 service.ping_state = SERVICE_MONITOR__INVALID_RESPONSE_RECEIVED
-            service.save()
+            service.request_token = None
+            writer.save(service, "last_response_date", "ping_state", "request_token")
             
-            # Create an entry in the PingLog
-            pinglog_entry = PingLog(service=service,date=current_date,ping_state=service.ping_state)
-            pinglog_entry.save()
+            # Create an entry in the PingLog; both are written once the buffer is due to be flushed
+            if latency_ms is None:
+                writer.log(service, current_date)
+            else:
+                writer.log(service, current_date, latency_ms=latency_ms, total_ms=int(round(latency_ms)))
+            writer.flush_if_due()
             
-            # If an invalid response was received, send a notification email
+            # If an invalid response was received, the service recovered from an alert, or it became degraded or recovered from that, send a notification email
             if service.ping_state == SERVICE_MONITOR__INVALID_RESPONSE_RECEIVED:
-                send_notification_email(service)
+                action = alert_tracker.observe(service, True)
+                if action:
+                    send_notification_email(service,repeated=(action == REALERT))
+            else:
+                if alert_tracker.observe(service, False) == RECOVERED:
+                    send_notification_email(service,recovered=True)
+                if is_degraded != was_degraded:
+                    send_notification_email(service,latency_ms=latency_tracker.percentile(service),latency_recovered=was_degraded)
         except Exception, e:
             self.exception(e)
         
@@ -0,0 +1,454 @@
+import asyncore
+import datetime
+import errno
+import mimetools
+import os
+import pytz
+import re
+import socket
+import ssl
+import StringIO
+import sys
+import threading
+import time
+import urllib2
+import urlparse
+
+from collections import deque
+from .models import SERVICE_MONITOR__HEAD
+from .probe import ProbeResult, Deadline, InvalidResponseError, CircuitOpenError, circuit_breaker, ssl_context, host_key, elapsed_ms
+from .probe import SERVICE_MONITOR_MAX_PROBES_PER_HOST, SERVICE_MONITOR_MAX_REDIRECTS, SERVICE_MONITOR_CONNECT_TIMEOUT_SECONDS, SERVICE_MONITOR_READ_TIMEOUT_SECONDS
+from django.conf import settings
+
+# The maximum number of probes in flight at once in the probe daemon
+SERVICE_MONITOR_MAX_ASYNC_PROBES = getattr(settings, "SERVICE_MONITOR_MAX_ASYNC_PROBES", 2000)
+
+# The number of seconds host names resolved by the probe daemon are cached
+SERVICE_MONITOR_DNS_CACHE_SECONDS = getattr(settings, "SERVICE_MONITOR_DNS_CACHE_SECONDS", 60)
+
+# The number of seconds host names which could not be resolved by the
+# probe daemon are cached as such
+SERVICE_MONITOR_DNS_FAILURE_CACHE_SECONDS = getattr(settings, "SERVICE_MONITOR_DNS_FAILURE_CACHE_SECONDS", 5)
+
+# The socket errors which only mean that the operation would block
+WOULD_BLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
+
+"""
+Caches the address each (host, port) resolves to for ttl_seconds, since
+resolving blocks the event loop. Hosts which cannot be resolved are
+cached as such for failure_ttl_seconds, so that the probes of a host
+whose name server is down do not each block the loop on it.
+"""
+class ResolverCache(object):
+    def __init__(self, ttl_seconds=None, failure_ttl_seconds=None):
+        self.ttl_seconds = ttl_seconds or SERVICE_MONITOR_DNS_CACHE_SECONDS
+        self.failure_ttl_seconds = failure_ttl_seconds or SERVICE_MONITOR_DNS_FAILURE_CACHE_SECONDS
+        self.lock = threading.Lock()
+        self.addresses = {}
+
+    """
+    Returns (family, address) for the given host and port, or raises
+    the socket.error resolving it raised.
+    """
+    def resolve(self, host, port):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            cached = self.addresses.get((host, port))
+        finally:
+            self.lock.release()
+        if cached is not None and cached[0] > now:
+            expires, resolved, error = cached
+            if error is not None:
+                raise error
+            return resolved
+        try:
+            info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        except socket.error, e:
+            self.lock.acquire()
+            try:
+                self.addresses[(host, port)] = (now + self.failure_ttl_seconds, None, e)
+            finally:
+                self.lock.release()
+            raise
+        resolved = (info[0], info[4])
+        self.lock.acquire()
+        try:
+            self.addresses[(host, port)] = (now + self.ttl_seconds, resolved, None)
+        finally:
+            self.lock.release()
+        return resolved
+
+"""
+A single HTTP request of a probe on a non-blocking socket, driven by
+the AsyncProbeEngine's event loop. Requests are sent as HTTP/1.0 with
+"Connection: close", so the response is never chunked and its body
+ends when the server closes the connection (or at its Content-Length).
+
+Each phase (connecting and the TLS handshake, then sending and each
+read) must finish before expires, which is the smaller of the phase's
+timeout and the probe's deadline; the engine fails requests which
+run past it.
+"""
+class ProbeChannel(asyncore.dispatcher):
+    def __init__(self, engine, probe, url, redirects):
+        asyncore.dispatcher.__init__(self, map=engine.map)
+        self.engine = engine
+        self.probe = probe
+        self.url = url
+        self.redirects = redirects
+        self.handshaking = False
+        self.outbuf = ""
+        self.inbuf = []
+        self.status = None
+        self.reason = None
+        self.headers = None
+        self.content_length = None
+        self.body = []
+        self.done = False
+
+        result = probe.result
+        service = result.service
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise urllib2.URLError("unknown url type: %s" % parts.scheme)
+        self.https = (parts.scheme == "https")
+        self.hostname = parts.hostname
+        if self.https:
+            port = parts.port or 443
+        else:
+            port = parts.port or 80
+        if service.http_method == SERVICE_MONITOR__HEAD:
+            self.method = "HEAD"
+        else:
+            self.method = "GET"
+        path = urlparse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        host = parts.hostname
+        if parts.port:
+            host = "%s:%s" % (host, parts.port)
+        self.outbuf = "%s %s HTTP/1.0\r\nHost: %s\r\nUser-Agent: service-monitor\r\nConnection: close\r\n\r\n" % (self.method, path, host)
+
+        step = time.time()
+        family, address = engine.resolver.resolve(parts.hostname, port)
+        result.dns_ms += elapsed_ms(step)
+
+        self.connect_started = time.time()
+        self.expires = min(probe.deadline.expires, self.connect_started + (service.connect_timeout_seconds or SERVICE_MONITOR_CONNECT_TIMEOUT_SECONDS))
+        self.create_socket(family, socket.SOCK_STREAM)
+        try:
+            self.connect(address)
+        except:
+            self.close()
+            raise
+
+    def read_timeout(self):
+        return self.probe.result.service.read_timeout_seconds or SERVICE_MONITOR_READ_TIMEOUT_SECONDS
+
+    def extend(self, seconds):
+        self.expires = min(self.probe.deadline.expires, time.time() + seconds)
+
+    def readable(self):
+        return not self.done
+
+    def writable(self):
+        return not self.done and (not self.connected or self.handshaking or bool(self.outbuf))
+
+    def handle_connect(self):
+        if self.https:
+            self.del_channel()
+            # The host name is sent as SNI and, unless SERVICE_MONITOR_VERIFY_CERTIFICATES is False, checked against the certificate
+            self.set_socket(ssl_context.wrap_socket(self.socket, server_hostname=self.hostname, do_handshake_on_connect=False))
+            self.handshaking = True
+            self.handshake()
+        else:
+            self.probe.result.connect_ms += elapsed_ms(self.connect_started)
+            self.extend(self.read_timeout())
+
+    def handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        self.handshaking = False
+        self.probe.result.connect_ms += elapsed_ms(self.connect_started)
+        self.extend(self.read_timeout())
+
+    def handle_write(self):
+        if self.handshaking:
+            self.handshake()
+            return
+        try:
+            sent = self.socket.send(self.outbuf)
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                return
+            raise
+        except socket.error, e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            raise
+        self.outbuf = self.outbuf[sent:]
+        self.extend(self.read_timeout())
+
+    def handle_read(self):
+        if self.handshaking:
+            self.handshake()
+            return
+        while not self.done:
+            try:
+                data = self.socket.recv(8192)
+            except ssl.SSLError, e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    return
+                raise
+            except socket.error, e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                raise
+            if not data:
+                self.handle_close()
+                return
+            self.extend(self.read_timeout())
+            self.feed(data)
+            if not (self.https and self.socket.pending()):
+                return
+
+    """
+    Parses the status line and headers once they are all in, then
+    counts the body, and finishes the request as soon as nothing more
+    needs to be read.
+    """
+    def feed(self, data):
+        result = self.probe.result
+        if self.headers is None:
+            self.inbuf.append(data)
+            received = "".join(self.inbuf)
+            end = received.find("\r\n\r\n")
+            if end < 0:
+                return
+            self.inbuf = []
+            result.ttfb_ms = elapsed_ms(self.probe.start)
+            lines = received[:end].split("\r\n", 1)
+            status = lines[0].split(None, 2)
+            try:
+                self.status = int(status[1])
+            except (IndexError, ValueError):
+                raise urllib2.URLError("bad status line: %r" % lines[0])
+            self.reason = len(status) > 2 and status[2] or ""
+            self.headers = mimetools.Message(StringIO.StringIO(len(lines) > 1 and lines[1] + "\r\n" or ""))
+            result.status_code = self.status
+            result.body_bytes = 0
+            if self.headers.getheader("content-length", "").isdigit():
+                self.content_length = int(self.headers.getheader("content-length"))
+            # Only the body of a 2xx response to a GET is of any interest
+            if self.method == "HEAD" or not (200 <= self.status < 300):
+                self.finish()
+                return
+            data = received[end + 4:]
+
+        service = result.service
+        if service.max_body_bytes is not None:
+            data = data[:service.max_body_bytes - result.body_bytes]
+        result.body_bytes += len(data)
+        if service.valid_body_regex:
+            self.body.append(data)
+        if (service.max_body_bytes is not None and result.body_bytes >= service.max_body_bytes) or (self.content_length is not None and result.body_bytes >= self.content_length):
+            self.finish()
+
+    def handle_close(self):
+        if self.done:
+            return
+        if self.headers is not None:
+            self.finish()
+        else:
+            error = 0
+            try:
+                error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            except socket.error:
+                pass
+            if error:
+                self.fail(socket.error(error, os.strerror(error)))
+            else:
+                self.fail(urllib2.URLError("connection closed before a response was received"))
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def close(self):
+        self.done = True
+        asyncore.dispatcher.close(self)
+
+    """
+    Completes the request: follows a redirect with a new channel, or
+    completes the probe with the outcome of the response.
+    """
+    def finish(self):
+        self.close()
+        result = self.probe.result
+        result.body = "".join(self.body)
+        location = self.headers.getheader("location")
+        if 300 <= self.status < 400 and location:
+            if self.redirects >= SERVICE_MONITOR_MAX_REDIRECTS:
+                self.engine.complete(self.probe, urllib2.HTTPError(self.url, self.status, "Too many redirects", self.headers, None))
+            else:
+                self.engine.open(self.probe, urlparse.urljoin(self.url, location), self.redirects + 1)
+        elif 200 <= self.status < 300:
+            if result.service.valid_body_regex and not re.search(result.service.valid_body_regex, result.body):
+                self.engine.complete(self.probe, InvalidResponseError("Response body does not match '%s'" % result.service.valid_body_regex))
+            else:
+                self.engine.complete(self.probe, None)
+        else:
+            self.engine.complete(self.probe, urllib2.HTTPError(self.url, self.status, self.reason, self.headers, None))
+
+    """
+    Fails the probe with the given error, wrapping network errors in
+    urllib2.URLError like urlopen.
+    """
+    def fail(self, error):
+        if self.done:
+            return
+        self.close()
+        if not isinstance(error, urllib2.URLError):
+            error = urllib2.URLError(error)
+        self.engine.complete(self.probe, error)
+
+"""
+A probe in progress: its result, the time it was started at and its
+deadline, and the host it counts against.
+"""
+class AsyncProbe(object):
+    def __init__(self, service):
+        self.result = ProbeResult(service)
+        self.host = host_key(service.url)
+        self.start = None
+        self.deadline = None
+        self.channel = None
+
+"""
+Probes HTTP services on non-blocking sockets from a single thread,
+for the probe daemon (see the runprobes management command). Unlike
+ProbeEngine, it does not probe a batch and wait for all of it:
+services are started as they become due, and poll() runs the event
+loop for a while and returns the results of the probes which have
+finished in the meantime, so thousands of probes can be in flight at
+once on one core.
+
+At most max_in_flight probes are in flight at once, and at most
+max_per_host of those target the same host; the others wait for a
+slot. Probes obey the same connect, read and deadline limits and the
+same circuit breakers as ProbeEngine, but do not keep connections
+alive.
+"""
+class AsyncProbeEngine(object):
+    def __init__(self, max_in_flight=None, max_per_host=None, breaker=None, resolver=None):
+        self.max_in_flight = max_in_flight or SERVICE_MONITOR_MAX_ASYNC_PROBES
+        self.max_per_host = max_per_host or SERVICE_MONITOR_MAX_PROBES_PER_HOST
+        self.breaker = breaker or circuit_breaker
+        self.resolver = resolver or ResolverCache()
+        self.map = {}
+        self.waiting = deque()
+        self.in_flight = {}
+        self.probes = set()
+        self.finished = []
+        self.dispatching = False
+        self.needs_dispatch = False
+
+    def __len__(self):
+        return len(self.waiting) + len(self.probes)
+
+    """
+    Starts probing the given service, or queues it until there is a
+    slot for it.
+    """
+    def start(self, service):
+        self.waiting.append(AsyncProbe(service))
+        self.dispatch()
+
+    """
+    Starts as many of the waiting probes as there are slots for. Probes
+    which fail to open complete, and free their slots, from within this
+    loop; rather than recursing, it then goes over the waiting probes
+    again.
+    """
+    def dispatch(self):
+        self.needs_dispatch = True
+        if self.dispatching:
+            return
+        self.dispatching = True
+        try:
+            while self.needs_dispatch:
+                self.needs_dispatch = False
+                skipped = deque()
+                while self.waiting and len(self.probes) < self.max_in_flight:
+                    probe = self.waiting.popleft()
+                    if self.in_flight.get(probe.host, 0) >= self.max_per_host:
+                        skipped.append(probe)
+                        continue
+                    result = probe.result
+                    result.started = datetime.datetime.now(tz=pytz.utc)
+                    probe.start = time.time()
+                    result.dns_ms = 0
+                    result.connect_ms = 0
+                    if not self.breaker.allow(probe.host):
+                        result.error = CircuitOpenError("Circuit breaker open for host %s" % probe.host)
+                        result.total_ms = 0
+                        result.finished = result.started
+                        self.finished.append(result)
+                        continue
+                    probe.deadline = Deadline(result.service.get_timeout_seconds())
+                    self.in_flight[probe.host] = self.in_flight.get(probe.host, 0) + 1
+                    self.probes.add(probe)
+                    self.open(probe, result.service.url, 0)
+                skipped.extend(self.waiting)
+                self.waiting = skipped
+        finally:
+            self.dispatching = False
+
+    """
+    Sends a request of the given probe for the given url.
+    """
+    def open(self, probe, url, redirects):
+        try:
+            probe.channel = ProbeChannel(self, probe, url, redirects)
+        except Exception, e:
+            if not isinstance(e, urllib2.URLError):
+                e = urllib2.URLError(e)
+            self.complete(probe, e)
+
+    """
+    Records the outcome of the given probe.
+    """
+    def complete(self, probe, error):
+        if probe not in self.probes:
+            return
+        self.probes.discard(probe)
+        self.in_flight[probe.host] -= 1
+        if not self.in_flight[probe.host]:
+            del self.in_flight[probe.host]
+        result = probe.result
+        result.error = error
+        result.total_ms = elapsed_ms(probe.start)
+        result.request_ms = result.total_ms - (result.dns_ms or 0) - (result.connect_ms or 0)
+        result.finished = datetime.datetime.now(tz=pytz.utc)
+        self.breaker.record(probe.host, not result.unreachable())
+        self.finished.append(result)
+        self.dispatch()
+
+    """
+    Runs the event loop for up to the given number of seconds, fails
+    the requests which ran past their timeouts, and returns the
+    ProbeResults of the probes which finished.
+    """
+    def poll(self, timeout):
+        if self.map:
+            asyncore.loop(timeout, True, self.map, 1)
+        elif timeout > 0:
+            time.sleep(timeout)
+        now = time.time()
+        for probe in list(self.probes):
+            if probe.channel is not None and not probe.channel.done and now >= probe.channel.expires:
+                probe.channel.fail(socket.timeout("timed out"))
+        finished, self.finished = self.finished, []
+        return finished
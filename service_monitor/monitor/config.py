@@ -0,0 +1,216 @@
+import logging
+import threading
+import time
+
+from .models import *
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal
+from django.conf import settings
+
+# The number of seconds the configuration snapshot and its version stamp
+# are kept in the cache (at most 30 days, the longest memcached allows)
+SERVICE_MONITOR_CONFIG_CACHE_SECONDS = getattr(settings, "SERVICE_MONITOR_CONFIG_CACHE_SECONDS", 24 * 60 * 60)
+
+# The number of services or connections stored in each cache entry of
+# the snapshot, which keeps each entry well below the largest item
+# memcached stores (1 MB by default)
+SERVICE_MONITOR_CONFIG_CACHE_CHUNK_SIZE = getattr(settings, "SERVICE_MONITOR_CONFIG_CACHE_CHUNK_SIZE", 100)
+
+# The cache keys of the version stamp, of the number of chunks of each
+# version of the snapshot and of each of those chunks
+VERSION_KEY = "monitor:service_config:version"
+SNAPSHOT_KEY = "monitor:service_config:%s"
+CHUNK_KEY = "monitor:service_config:%s:%s"
+
+logger = logging.getLogger("monitor.config")
+
+# The fields of a Service which hold its monitoring state rather than
+# its configuration, and change on every ping
+STATE_FIELDS = (
+    "last_request_date"
+   ,"last_response_date"
+   ,"ping_state"
+   ,"next_ping_at"
+   ,"timeout_at"
+   ,"request_token"
+   ,"lease_owner"
+   ,"lease_expires_at"
+)
+
+CONFIG_FIELDS = [field.attname for field in Service._meta.local_fields if field.attname not in STATE_FIELDS]
+
+# Sent when the configuration was changed by another process, i.e. when
+# a Service was edited in the admin
+service_config_changed = Signal()
+
+def config_values(service):
+    return tuple([getattr(service, attname) for attname in CONFIG_FIELDS])
+
+"""
+A read-through cache of the configuration of the active services,
+along with their RapidSMS connections (and the backends of those),
+so that the SMS outbox, the notification emails and the SMS lookup
+index can get at the connection of a service without a query each.
+
+The snapshot is loaded from the database with a single query, kept in
+this process and shared with the other monitor processes through the
+Django cache (memcached, see CACHES in settings.py) under a version
+stamp, split into chunks of chunk_size services or connections so
+that no cache entry outgrows the largest item memcached stores. Saving a Service with a changed configuration or deleting one
+bumps the version, so that every process loads the new snapshot once;
+the state changes written on each ping leave it alone. check() picks
+up versions bumped by other processes and sends
+service_config_changed, on which the schedule and the lookup index
+are rebuilt right away rather than on their next reload.
+"""
+class ServiceConfigCache(object):
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or SERVICE_MONITOR_CONFIG_CACHE_CHUNK_SIZE
+        self.lock = threading.RLock()
+        self.version = None
+        self.snapshot = None
+
+    """
+    Returns the current version stamp, creating one if the cache holds
+    none. If the cache cannot be reached, the version this process
+    last saw is kept.
+    """
+    def current_version(self):
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            # Stamped with the time so that snapshots of an expired version are never reused
+            version = int(time.time() * 1000)
+            if not cache.add(VERSION_KEY, version, SERVICE_MONITOR_CONFIG_CACHE_SECONDS):
+                version = cache.get(VERSION_KEY) or self.version or version
+        return version
+
+    """
+    Loads the snapshot of the configuration of all active services from
+    the database.
+    """
+    def load(self):
+        snapshot = {"configs": {}, "connections": {}}
+        for service in Service.objects.filter(active=True).select_related("connection__backend"):
+            snapshot["configs"][service.pk] = config_values(service)
+            if service.connection_id is not None:
+                snapshot["connections"][service.connection_id] = service.connection
+        return snapshot
+
+    """
+    Returns the snapshot of the given version from the cache, or None if
+    the cache does not hold all of its chunks.
+    """
+    def fetch(self, version):
+        count = cache.get(SNAPSHOT_KEY % version)
+        if count is None:
+            return None
+        keys = [CHUNK_KEY % (version, i) for i in range(count)]
+        chunks = cache.get_many(keys)
+        if len(chunks) < count:
+            return None
+        snapshot = {"configs": {}, "connections": {}}
+        for key in keys:
+            for name, item_key, value in chunks[key]:
+                snapshot[name][item_key] = value
+        return snapshot
+
+    """
+    Stores the given snapshot of the given version in the cache, in
+    chunks of chunk_size services or connections.
+    """
+    def store(self, version, snapshot):
+        items = [(name, key, value) for name in ("configs", "connections") for key, value in snapshot[name].items()]
+        entries = {}
+        for i in range(0, len(items), self.chunk_size):
+            entries[CHUNK_KEY % (version, len(entries))] = items[i:i + self.chunk_size]
+        entries[SNAPSHOT_KEY % version] = len(entries)
+        cache.set_many(entries, SERVICE_MONITOR_CONFIG_CACHE_SECONDS)
+        # The cache does not say when it could not store something, e.g. an entry larger than memcached allows
+        if len(cache.get_many(entries.keys())) < len(entries):
+            logger.warning("Could not store the snapshot of the service configuration in the cache; each process will load its own")
+
+    """
+    Returns the snapshot for the version this process last saw, loading
+    it from the cache, or from the database if the cache does not have
+    it yet.
+    """
+    def get(self):
+        self.lock.acquire()
+        try:
+            if self.version is None:
+                self.version = self.current_version()
+            if self.snapshot is None:
+                snapshot = self.fetch(self.version)
+                if snapshot is None:
+                    snapshot = self.load()
+                    self.store(self.version, snapshot)
+                self.snapshot = snapshot
+            return self.snapshot
+        finally:
+            self.lock.release()
+
+    """
+    Checks the version stamp for changes made by other processes, and
+    sends service_config_changed if there were any. Called once per
+    run, so that reading the configuration costs a single cache read.
+    """
+    def check(self):
+        self.lock.acquire()
+        try:
+            version = self.current_version()
+            changed = self.version is not None and version != self.version
+            if version != self.version:
+                self.version = version
+                self.snapshot = None
+        finally:
+            self.lock.release()
+        if changed:
+            service_config_changed.send(sender=self.__class__)
+
+    """
+    Bumps the version stamp, so that every process loads a new snapshot.
+    """
+    def bump(self):
+        self.lock.acquire()
+        try:
+            try:
+                self.version = cache.incr(VERSION_KEY)
+            except ValueError:
+                # The version has expired (or the cache cannot be reached)
+                self.version = None
+                self.version = self.current_version()
+            self.snapshot = None
+        finally:
+            self.lock.release()
+
+    """
+    Returns the RapidSMS connection of the given service, with its
+    backend, from the snapshot.
+    """
+    def connection(self, service):
+        connection = self.get()["connections"].get(service.connection_id)
+        if connection is None:
+            connection = service.connection
+        return connection
+
+    """
+    Bumps the version if the configuration of the given service differs
+    from the snapshot.
+    """
+    def update(self, service):
+        configs = self.get()["configs"]
+        if (service.active or service.pk in configs) and configs.get(service.pk) != config_values(service):
+            self.bump()
+
+# The configuration cache shared by everything running in this process
+service_config = ServiceConfigCache()
+
+def update_service_config(sender, instance, **kwargs):
+    service_config.update(instance)
+
+def bump_service_config(sender, instance, **kwargs):
+    service_config.bump()
+
+post_save.connect(update_service_config, sender=Service, dispatch_uid="monitor.config.update_service_config")
+post_delete.connect(bump_service_config, sender=Service, dispatch_uid="monitor.config.bump_service_config")
@@ -0,0 +1,142 @@
+import datetime
+import logging
+import pytz
+import signal
+
+from .models import *
+from .asyncprobe import AsyncProbeEngine
+from .probe import latency_tracker
+from .schedule import ProbeSchedule
+from .writer import PingLogWriter
+from .alerts import alert_tracker
+from .tasks import record_http_results
+from .config import service_config, service_config_changed
+from django.db.models.signals import post_save, post_delete
+
+# The maximum number of seconds the probe daemon waits on its probes
+# before checking the schedule again
+TICK_SECONDS = 1.0
+
+logger = logging.getLogger("monitor.daemon")
+
+"""
+The probe daemon run by the runprobes management command when
+SERVICE_MONITOR_PROBE_DISPATCH is "daemon". It probes all HTTP
+services from a single process, as its own supervisor program, so
+the router and celery only deal with SMS services.
+
+Rather than probing a batch of services and waiting for all of them,
+it starts each service on the AsyncProbeEngine as soon as it is due
+and records each result as soon as it comes in, so a few slow hosts
+never hold up the others and thousands of probes can be in flight at
+once. Results are written through a PingLogWriter, flushed every
+SERVICE_MONITOR_WRITE_BUFFER_SECONDS, and the leases of the services
+whose results were written are released after each flush.
+
+On SIGTERM or SIGINT it stops starting probes, waits for those in
+flight to finish (each is bounded by its deadline), flushes and
+releases everything, and returns.
+"""
+class ProbeDaemon(object):
+    def __init__(self, engine=None, result_writer=None):
+        self.engine = engine or AsyncProbeEngine()
+        self.writer = result_writer or PingLogWriter()
+        self.schedule = ProbeSchedule(service_types=[SERVICE_MONITOR__HTTP])
+        self.in_flight = set()
+        self.finished_ids = []
+        self.stopping = False
+
+    def stop(self, *args):
+        self.stopping = True
+
+    """
+    Leases the services which are due and starts probing those which
+    can be pinged again.
+    """
+    def start_due(self):
+        # Services still being probed are due again once their timeout passes, but are left alone
+        service_ids = [service_id for service_id in self.schedule.pop_due() if service_id not in self.in_flight]
+        if not service_ids:
+            return
+        idle_ids = []
+        for service in Service.objects.lease(service_ids):
+            if service.service_type == SERVICE_MONITOR__HTTP and service.can_ping_again():
+                # Start tracking latency and alerts from the state the service was last left in
+                latency_tracker.seed(service)
+                alert_tracker.seed(service)
+
+                # Mark the request as being sent for this service
+                current_date = datetime.datetime.now(tz=pytz.utc)
+                service.last_request_date = current_date
+                service.last_response_date = None
+                service.ping_state = SERVICE_MONITOR__REQUEST_SENT
+                self.writer.save(service, "last_request_date", "last_response_date", "ping_state")
+
+                # Create an entry in the PingLog; while the service is alerted on, it is only counted in the rollups
+                self.writer.log(service, current_date, rollup_only=alert_tracker.is_alerting(service))
+
+                self.in_flight.add(service.pk)
+                self.engine.start(service)
+            else:
+                idle_ids.append(service.pk)
+            # Services that turn out not to need anything yet are put back on the schedule
+            self.schedule.push(service)
+        if idle_ids:
+            Service.objects.release(idle_ids)
+
+    """
+    Records the results of the probes which finished, and flushes the
+    writer and releases their leases if it is due.
+    """
+    def record(self, results):
+        for result in results:
+            self.in_flight.discard(result.service.pk)
+            self.finished_ids.append(result.service.pk)
+        record_http_results(results, self.writer)
+        if self.writer.buffered_date is not None and datetime.datetime.now() - self.writer.buffered_date >= datetime.timedelta(seconds=self.writer.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        self.writer.flush()
+        finished_ids, self.finished_ids = self.finished_ids, []
+        if finished_ids:
+            Service.objects.release(finished_ids)
+
+    def reschedule(self, sender, instance, **kwargs):
+        self.schedule.push(instance)
+
+    def unschedule(self, sender, instance, **kwargs):
+        self.schedule.discard(instance)
+
+    def invalidate(self, sender, **kwargs):
+        self.schedule.invalidate()
+
+    def run_forever(self):
+        # Keep the schedule in step with the state written by the writer and any other save in this process
+        post_save.connect(self.reschedule, sender=Service, dispatch_uid="monitor.daemon.reschedule")
+        post_delete.connect(self.unschedule, sender=Service, dispatch_uid="monitor.daemon.unschedule")
+        service_config_changed.connect(self.invalidate, dispatch_uid="monitor.daemon.invalidate")
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            while not self.stopping or len(self.engine):
+                if not self.stopping:
+                    try:
+                        # Pick up services edited in other processes (see config.py)
+                        service_config.check()
+                        self.start_due()
+                    except Exception:
+                        logger.exception("Could not start the due probes")
+                timeout = TICK_SECONDS
+                if not self.stopping:
+                    seconds = self.schedule.seconds_until_due()
+                    if seconds is not None and seconds < timeout:
+                        timeout = seconds
+                try:
+                    self.record(self.engine.poll(timeout))
+                except Exception:
+                    logger.exception("Could not record the probe results")
+        finally:
+            self.flush()
+            if self.in_flight:
+                Service.objects.release(list(self.in_flight))
@@ -0,0 +1,73 @@
+import bisect
+import hashlib
+
+from .models import *
+from .probe import host_key
+from django.conf import settings
+
+# Where HTTP services are probed: "router" to probe them from the
+# EventSchedule callback in the router process, "celery" to have
+# celerybeat dispatch them in shards to the celeryd workers, or
+# "daemon" to probe them from the runprobes management command
+SERVICE_MONITOR_PROBE_DISPATCH = getattr(settings, "SERVICE_MONITOR_PROBE_DISPATCH", "router")
+
+# The number of shards the due HTTP services are split into each minute
+# when probing through celery. Each shard has its own queue, consumed by
+# a single celeryd process, so this must match the number of celeryd
+# processes (numprocs in supervisor.conf)
+SERVICE_MONITOR_PROBE_SHARDS = getattr(settings, "SERVICE_MONITOR_PROBE_SHARDS", 4)
+
+# The name of the celery queue of each shard
+PROBE_SHARD_QUEUE = "monitor.probe_shard.%s"
+
+# The number of points each shard gets on the hash ring
+SHARD_REPLICAS = 100
+
+def hash_value(key):
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+"""
+A consistent hash ring mapping keys onto a fixed number of shards, so
+that a key always lands in the same shard and changing the number of
+shards only moves a small fraction of the keys.
+"""
+class HashRing(object):
+    def __init__(self, shards):
+        self.shards = shards
+        points = []
+        for shard in range(shards):
+            for replica in range(SHARD_REPLICAS):
+                points.append((hash_value("%s-%s" % (shard, replica)), shard))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.points = [point[1] for point in points]
+
+    def shard_for(self, key):
+        index = bisect.bisect(self.hashes, hash_value(key)) % len(self.hashes)
+        return self.points[index]
+
+"""
+Returns the key an HTTP service is sharded on: its host, so that all
+services on the same host land in the same shard queue, are probed by
+the celeryd process consuming it and share its per-host concurrency
+cap and keep-alive connections.
+"""
+def shard_key(service):
+    return host_key(service.url) or str(service.pk)
+
+"""
+Splits the given HTTP services into at most the given number of
+shards. Returns a dictionary of the lists of service ids by shard.
+"""
+def split_into_shards(services, shards=None):
+    ring = HashRing(shards or SERVICE_MONITOR_PROBE_SHARDS)
+    split = {}
+    for service in services:
+        split.setdefault(ring.shard_for(shard_key(service)), []).append(service.pk)
+    return split
+
+"""
+Returns the name of the celery queue the given shard is routed to.
+"""
+def shard_queue(shard):
+    return PROBE_SHARD_QUEUE % shard
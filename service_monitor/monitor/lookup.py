@@ -0,0 +1,201 @@
+import datetime
+import re
+import threading
+
+from .models import *
+from .schedule import SERVICE_MONITOR_SCHEDULE_RELOAD_MINUTES
+from .config import service_config, service_config_changed
+from django.db.models.signals import post_save, post_delete
+
+"""
+An immutable snapshot of a Service as it was last saved, along with
+its valid_response_regex compiled once. service() returns a new,
+unsaved-looking Service instance with the snapshot's values, which
+can be changed and handed to the writer without reading the database.
+"""
+class ServiceDescriptor(object):
+    def __init__(self, service):
+        self.values = dict([(field.attname, getattr(service, field.attname)) for field in Service._meta.local_fields])
+        valid_response_regex = service.valid_response_regex
+        if (valid_response_regex is None) or (valid_response_regex == ""):
+            valid_response_regex = r"^(.+)$"
+        self.regex = re.compile(valid_response_regex)
+
+    def service(self):
+        return Service(**self.values)
+
+# Splits a reply into the words which may be correlation tokens
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+"""
+An in-memory index of the SMS services by the identity of their
+connection and by the correlation token of their outstanding
+request, so that the SMS handler can match a reply to the request
+it answers without any database read.
+
+A reply is matched to the outstanding request whose token it
+contains. Replies without a known token can only be matched when the
+connection is used by a single service, or by a single service
+awaiting a response. The dates the requests were handed off to be
+sent are kept with their tokens, to measure the round trip time of
+each one.
+
+The index is loaded with a single query and then kept in step with
+every save and delete of a Service made in this process through
+signals, including the state changes flushed by the writer. Like the
+schedule, it is rebuilt every SERVICE_MONITOR_SCHEDULE_RELOAD_MINUTES
+to pick up edits made in other processes, and an identity not found
+in it is looked up in the database.
+"""
+class ServiceIndex(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.descriptors = {}
+        self.by_identity = {}
+        self.identities = {}
+        self.tokens = {}
+        self.sent_dates = {}
+        self.connection_identities = {}
+        self.loaded_date = None
+
+    """
+    Marks the index as stale so that it is rebuilt on next use.
+    """
+    def invalidate(self):
+        self.lock.acquire()
+        try:
+            self.loaded_date = None
+        finally:
+            self.lock.release()
+
+    def needs_reload(self, now):
+        if self.loaded_date is None:
+            return True
+        return now - self.loaded_date > datetime.timedelta(minutes=SERVICE_MONITOR_SCHEDULE_RELOAD_MINUTES)
+
+    """
+    Rebuilds the index from all services with a connection.
+    """
+    def reload(self, now=None):
+        now = now or datetime.datetime.now()
+        self.lock.acquire()
+        try:
+            self.descriptors = {}
+            self.by_identity = {}
+            self.identities = {}
+            self.tokens = {}
+            for service in Service.objects.filter(connection__isnull=False).select_related("connection"):
+                self.connection_identities[service.connection_id] = service.connection.identity
+                self.add(service)
+            self.loaded_date = now
+        finally:
+            self.lock.release()
+
+    def add(self, service):
+        identity = self.connection_identities[service.connection_id]
+        descriptor = ServiceDescriptor(service)
+        self.descriptors[service.pk] = descriptor
+        self.by_identity.setdefault(identity, set()).add(service.pk)
+        self.identities[service.pk] = identity
+        if service.request_token:
+            self.tokens[service.request_token] = service.pk
+
+    """
+    Returns the descriptor of the service the given reply from the
+    connection with the given identity answers. Raises
+    Service.DoesNotExist if it cannot be told.
+    """
+    def match(self, identity, text):
+        self.lock.acquire()
+        try:
+            if self.needs_reload(datetime.datetime.now()):
+                self.reload()
+            if identity not in self.by_identity:
+                for service in Service.objects.select_related("connection").filter(connection__identity=identity):
+                    self.update(service)
+
+            service_ids = self.by_identity.get(identity, set())
+            for word in TOKEN_RE.findall(text.lower()):
+                service_id = self.tokens.get(word)
+                if service_id in service_ids:
+                    return self.descriptors[service_id]
+
+            # Without a token, the reply can only be matched if there is just one candidate
+            if len(service_ids) == 1:
+                return self.descriptors[list(service_ids)[0]]
+            awaiting = [service_id for service_id in service_ids if self.descriptors[service_id].values["ping_state"] == SERVICE_MONITOR__REQUEST_SENT]
+            if len(awaiting) == 1:
+                return self.descriptors[awaiting[0]]
+            raise Service.DoesNotExist("No outstanding request from %s matches the reply: %s" % (identity, text))
+        finally:
+            self.lock.release()
+
+    """
+    Records that the request of the given service was handed off to be
+    sent at the given date.
+    """
+    def sent(self, service, date):
+        self.lock.acquire()
+        try:
+            if service.request_token:
+                self.sent_dates[service.request_token] = date
+        finally:
+            self.lock.release()
+
+    """
+    Returns (and forgets) the date the request with the given token was
+    handed off to be sent, or None if it is not known.
+    """
+    def pop_sent_date(self, token):
+        self.lock.acquire()
+        try:
+            return self.sent_dates.pop(token, None)
+        finally:
+            self.lock.release()
+
+    """
+    Replaces the descriptor of the given service with one for its
+    current values.
+    """
+    def update(self, service):
+        self.lock.acquire()
+        try:
+            self.discard(service)
+            if service.connection_id is not None:
+                if service.connection_id not in self.connection_identities:
+                    self.connection_identities[service.connection_id] = service_config.connection(service).identity
+                self.add(service)
+        finally:
+            self.lock.release()
+
+    def discard(self, service):
+        self.lock.acquire()
+        try:
+            descriptor = self.descriptors.pop(service.pk, None)
+            identity = self.identities.pop(service.pk, None)
+            if identity is not None:
+                self.by_identity[identity].discard(service.pk)
+                if not self.by_identity[identity]:
+                    del self.by_identity[identity]
+            if descriptor is not None and self.tokens.get(descriptor.values["request_token"]) == service.pk:
+                del self.tokens[descriptor.values["request_token"]]
+                if descriptor.values["request_token"] != service.request_token:
+                    self.sent_dates.pop(descriptor.values["request_token"], None)
+        finally:
+            self.lock.release()
+
+# The index shared by everything running in this process
+service_index = ServiceIndex()
+
+def update_service_index(sender, instance, **kwargs):
+    service_index.update(instance)
+
+def discard_from_service_index(sender, instance, **kwargs):
+    service_index.discard(instance)
+
+def invalidate_service_index(sender, **kwargs):
+    service_index.invalidate()
+
+post_save.connect(update_service_index, sender=Service, dispatch_uid="monitor.lookup.update_service_index")
+post_delete.connect(discard_from_service_index, sender=Service, dispatch_uid="monitor.lookup.discard_from_service_index")
+service_config_changed.connect(invalidate_service_index, dispatch_uid="monitor.lookup.invalidate_service_index")
@@ -0,0 +1,49 @@
+import datetime
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from monitor.models import *
+
+GRANULARITIES = {
+    "minute": SERVICE_MONITOR__MINUTE
+   ,"hourly": SERVICE_MONITOR__HOURLY
+   ,"daily": SERVICE_MONITOR__DAILY
+}
+
+"""
+Prints the p50/p95/p99 response latency (the round trip time for
+SMS services) of a service per period, from its PingLogRollups.
+"""
+class Command(BaseCommand):
+    args = "<service id>"
+    help = "Prints the p50/p95/p99 latency of a service per minute, hour or day."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--days"
+           ,type="int"
+           ,dest="days"
+           ,default=1
+           ,help="Report on the last this many days (default 1)."
+        ),
+        make_option("--granularity"
+           ,type="choice"
+           ,choices=GRANULARITIES.keys()
+           ,dest="granularity"
+           ,default="hourly"
+           ,help="One of minute, hourly or daily (default hourly)."
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the id of one service.")
+        try:
+            service = Service.objects.get(pk=args[0])
+        except (Service.DoesNotExist, ValueError):
+            raise CommandError("No service with id %s." % args[0])
+
+        start = datetime.datetime.now() - datetime.timedelta(days=options["days"])
+        self.stdout.write("%-20s %10s %10s %10s\n" % ("period", "p50 ms", "p95 ms", "p99 ms"))
+        for period_start, latencies in service.latency_trend(start, granularity=GRANULARITIES[options["granularity"]]):
+            self.stdout.write("%-20s %10.0f %10.0f %10.0f\n" % tuple([period_start.strftime("%Y-%m-%d %H:%M")] + latencies))
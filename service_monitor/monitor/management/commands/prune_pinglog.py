@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from monitor.retention import prune_pinglog, SERVICE_MONITOR_PINGLOG_RETENTION_DAYS, SERVICE_MONITOR_RETENTION_BATCH_SIZE
+
+"""
+Deletes PingLog entries older than the retention period in bounded
+batches, along with old minute and hourly PingLogRollups.
+"""
+class Command(BaseCommand):
+    help = "Deletes old PingLog entries and rollups in bounded batches."
+    
+    option_list = BaseCommand.option_list + (
+        make_option("--days"
+           ,type="int"
+           ,dest="days"
+           ,help="Delete entries older than this many days (default %s)." % SERVICE_MONITOR_PINGLOG_RETENTION_DAYS
+        ),
+        make_option("--batch-size"
+           ,type="int"
+           ,dest="batch_size"
+           ,help="The number of entries to process per transaction (default %s)." % SERVICE_MONITOR_RETENTION_BATCH_SIZE
+        ),
+        make_option("--max-batches"
+           ,type="int"
+           ,dest="max_batches"
+           ,help="Stop after this many batches (default no limit)."
+        ),
+    )
+    
+    def handle(self, *args, **options):
+        total = prune_pinglog(
+            days=options.get("days")
+           ,batch_size=options.get("batch_size")
+           ,max_batches=options.get("max_batches")
+        )
+        self.stdout.write("Deleted %s PingLog entries.\n" % total)
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from monitor.dispatch import SERVICE_MONITOR_PROBE_DISPATCH
+from monitor.asyncprobe import AsyncProbeEngine, SERVICE_MONITOR_MAX_ASYNC_PROBES
+from monitor.daemon import ProbeDaemon
+
+"""
+Runs the probe daemon, which probes all HTTP services from this
+process on non-blocking sockets until it is sent SIGTERM. Meant to
+run as its own supervisor program with SERVICE_MONITOR_PROBE_DISPATCH
+set to "daemon".
+"""
+class Command(BaseCommand):
+    help = "Runs the daemon probing HTTP services until it is stopped."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--max-probes"
+           ,type="int"
+           ,dest="max_probes"
+           ,help="The maximum number of probes in flight at once (default %s)." % SERVICE_MONITOR_MAX_ASYNC_PROBES
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if SERVICE_MONITOR_PROBE_DISPATCH != "daemon":
+            raise CommandError('SERVICE_MONITOR_PROBE_DISPATCH must be "daemon" to run the probe daemon.')
+        ProbeDaemon(engine=AsyncProbeEngine(max_in_flight=options.get("max_probes"))).run_forever()
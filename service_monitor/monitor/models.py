@@ -1,9 +1,22 @@
+import bisect
 import datetime
+import hashlib
+import os
 import pytz
+import random
+import socket
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models import Q
 from django.conf import settings
 
+# Identifies this monitor node when leasing services (defaults to the host name)
+SERVICE_MONITOR_NODE_NAME = getattr(settings, "SERVICE_MONITOR_NODE_NAME", socket.gethostname())
+
+# How long a monitor process may work on a service before other processes
+# may take it over; this should be longer than the longest probe
+SERVICE_MONITOR_LEASE_SECONDS = getattr(settings, "SERVICE_MONITOR_LEASE_SECONDS", 15 * 60)
+
 SERVICE_MONITOR__HTTP = 1
 SERVICE_MONITOR__SMS = 2
 
@@ -11,6 +24,15 @@ SERVICE_MONITOR__REQUEST_SENT = 1
 SERVICE_MONITOR__VALID_RESPONSE_RECEIVED = 2
 SERVICE_MONITOR__NO_RESPONSE = 3
 SERVICE_MONITOR__INVALID_RESPONSE_RECEIVED = 4
+SERVICE_MONITOR__DEGRADED = 5
+SERVICE_MONITOR__REQUEST_QUEUED = 6
+
+SERVICE_MONITOR__HOURLY = 1
+SERVICE_MONITOR__DAILY = 2
+SERVICE_MONITOR__MINUTE = 3
+
+SERVICE_MONITOR__GET = 1
+SERVICE_MONITOR__HEAD = 2
 
 SERVICE_MONITOR__SERVICE_TYPES = (
     (SERVICE_MONITOR__HTTP, "HTTP")
@@ -22,8 +44,105 @@ SERVICE_MONITOR__REQUEST_STATES = (
    ,(SERVICE_MONITOR__VALID_RESPONSE_RECEIVED, "Valid Response Received")
    ,(SERVICE_MONITOR__NO_RESPONSE, "No Response")
    ,(SERVICE_MONITOR__INVALID_RESPONSE_RECEIVED, "Invalid Response Received")
+   ,(SERVICE_MONITOR__DEGRADED, "Valid Response Received (Degraded)")
+   ,(SERVICE_MONITOR__REQUEST_QUEUED, "Request Queued")
+)
+
+SERVICE_MONITOR__ROLLUP_GRANULARITIES = (
+    (SERVICE_MONITOR__HOURLY, "Hourly")
+   ,(SERVICE_MONITOR__DAILY, "Daily")
+   ,(SERVICE_MONITOR__MINUTE, "Minute")
 )
 
+SERVICE_MONITOR__HTTP_METHODS = (
+    (SERVICE_MONITOR__GET, "GET")
+   ,(SERVICE_MONITOR__HEAD, "HEAD")
+)
+
+# Where the correlation token of each request goes in sms_to_send
+SERVICE_MONITOR__TOKEN_PLACEHOLDER = "{token}"
+
+# The characters correlation tokens are made of (no 0/o or 1/l/i, which
+# are easily mistyped)
+SERVICE_MONITOR__TOKEN_CHARACTERS = "abcdefghjkmnpqrstuvwxyz23456789"
+
+# The (local) date from which the ping intervals of all services are counted
+SERVICE_MONITOR__PHASE_EPOCH = datetime.datetime(2000, 1, 1)
+
+"""
+Returns a new random correlation token for an SMS request.
+"""
+def generate_token(length=5):
+    return "".join([random.choice(SERVICE_MONITOR__TOKEN_CHARACTERS) for i in range(length)])
+
+"""
+Converts the given datetime to a naive datetime in the local time
+zone, which is how Django returns DateTimeFields from the database.
+Naive datetimes are assumed to already be in the local time zone.
+"""
+def local_datetime(value):
+    if value is None or value.tzinfo is None:
+        return value
+    else:
+        return value.astimezone(pytz.timezone(settings.TIME_ZONE)).replace(tzinfo=None)
+
+class ServiceManager(models.Manager):
+    
+    """
+    Returns the active services which can be pinged again, or which
+    have an SMS request awaiting a response that has timed out, at
+    the given local naive date (defaults to now).
+    """
+    def due(self, date=None):
+        date = date or datetime.datetime.now()
+        return self.filter(active=True).filter(Q(next_ping_at__lte=date) | Q(timeout_at__lte=date))
+    
+    """
+    Atomically leases those of the given services which are not leased
+    by another node (or whose lease has expired) to the given owner for
+    the given number of seconds, and returns them. While a service is
+    leased no other node works on it, so any number of monitor nodes
+    can share the services without sending duplicate requests, and a
+    node which dies only holds on to its services until the leases
+    expire. The returned services should be checked against their
+    (freshly loaded) state and released with release() once their new
+    state has been written.
+    """
+    def lease(self, service_ids, owner=None, seconds=None):
+        owner = owner or node_id()
+        now = datetime.datetime.now()
+        expires_at = now + datetime.timedelta(seconds=seconds or SERVICE_MONITOR_LEASE_SECONDS)
+        self.filter(pk__in=service_ids).filter(Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now)).update(
+            lease_owner=owner
+           ,lease_expires_at=expires_at
+        )
+        return self.filter(pk__in=service_ids, active=True, lease_owner=owner, lease_expires_at__gt=now)
+    
+    """
+    Releases the leases the given owner holds on the given services.
+    """
+    def release(self, service_ids, owner=None):
+        owner = owner or node_id()
+        self.filter(pk__in=service_ids, lease_owner=owner).update(lease_owner=None, lease_expires_at=None)
+
+"""
+Returns the id this process leases services under. This includes the
+process id, since celeryd forks its workers after this module has been
+imported.
+"""
+def node_id():
+    return "%s:%s" % (SERVICE_MONITOR_NODE_NAME, os.getpid())
+
+"""
+Returns the number of milliseconds from start to end, or None if
+start is None. Either may be naive local or timezone aware.
+"""
+def milliseconds_between(start, end):
+    if start is None:
+        return None
+    delta = local_datetime(end) - local_datetime(start)
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds / 1000.0
+
 """
 A model which defines a service to monitor. To monitor another
 service, create another Service entry with the following fields 
@@ -59,7 +178,7 @@ class Service(models.Model):
     
     sms_to_send = models.CharField(
         max_length=160
-       ,help_text="For service type SMS only: the SMS to send to the service when checking for responsiveness."
+       ,help_text="For service type SMS only: the SMS to send to the service when checking for responsiveness. Include {token} where a short token identifying each request should go; if the service echoes it in its response, several services can share the same connection."
        ,blank=True
     )
     
@@ -77,6 +196,25 @@ class Service(models.Model):
        ,help_text="For service type HTTP only: the url to ping."
     )
     
+    http_method = models.IntegerField(
+        choices=SERVICE_MONITOR__HTTP_METHODS
+       ,default=SERVICE_MONITOR__GET
+       ,help_text="For service type HTTP only: the request method to use. HEAD only fetches the status and headers."
+    )
+    
+    max_body_bytes = models.IntegerField(
+        null=True
+       ,blank=True
+       ,help_text="For service type HTTP only: the maximum number of bytes of the response body to read before closing the connection (0 to stop after the headers). Leave blank to read the whole body."
+    )
+    
+    valid_body_regex = models.CharField(
+        max_length=200
+       ,null=True
+       ,blank=True
+       ,help_text="For service type HTTP only: a regular expression which must be found in the body read (see max body bytes) for the response to be valid. Leave blank to count any 2xx response as valid."
+    )
+    
     email_list = models.CharField(
         max_length=500
        ,help_text="A list of recipients for the email notification if the service is not responding (separate multiple email addresses with a | )."
@@ -90,6 +228,46 @@ class Service(models.Model):
         help_text="The number of minutes to wait before determining that the service has timed out."
     )
     
+    ping_interval_seconds = models.IntegerField(
+        null=True
+       ,blank=True
+       ,help_text="The number of seconds between each ping of the service, for intervals which are not whole minutes. Overrides ping interval minutes when set; intervals below a minute need SERVICE_MONITOR_PROBE_LOOP."
+    )
+    
+    timeout_seconds = models.IntegerField(
+        null=True
+       ,blank=True
+       ,help_text="The number of seconds to wait before determining that the service has timed out. Overrides timeout minutes when set."
+    )
+    
+    connect_timeout_seconds = models.IntegerField(
+        null=True
+       ,blank=True
+       ,help_text="For service type HTTP only: the number of seconds to wait for a connection (including any TLS handshake). Leave blank for the default (SERVICE_MONITOR_CONNECT_TIMEOUT_SECONDS)."
+    )
+    
+    read_timeout_seconds = models.IntegerField(
+        null=True
+       ,blank=True
+       ,help_text="For service type HTTP only: the number of seconds to wait for each read from the server. Leave blank for the default (SERVICE_MONITOR_READ_TIMEOUT_SECONDS). The whole request, however many reads it takes, is always cut off at the timeout."
+    )
+    
+    latency_slo_ms = models.IntegerField(
+        null=True
+       ,blank=True
+       ,help_text="The latency (in milliseconds) which responses should be within. If the given percentile of the latencies of the last responses exceeds it, the service is marked as degraded and an email notification is sent. Leave blank to disable."
+    )
+    
+    latency_slo_percentile = models.IntegerField(
+        default=95
+       ,help_text="The percentile of the latencies of the last responses compared to the latency limit."
+    )
+    
+    latency_slo_window = models.IntegerField(
+        default=20
+       ,help_text="The number of last responses whose latencies are compared to the latency limit."
+    )
+    
     active = models.BooleanField(
         default=True
     )
@@ -110,9 +288,185 @@ class Service(models.Model):
        ,blank=True
     )
     
+    # The following are derived from the fields above on every save
+    # (see update_schedule) so that due services can be selected with
+    # an indexed range query. See sql/service.sql for the indexes.
+    next_ping_at = models.DateTimeField(
+        null=True
+       ,blank=True
+       ,editable=False
+    )
+    
+    timeout_at = models.DateTimeField(
+        null=True
+       ,blank=True
+       ,editable=False
+    )
+    
+    # The correlation token of the last SMS request (see sms_text)
+    request_token = models.CharField(
+        max_length=16
+       ,null=True
+       ,blank=True
+       ,editable=False
+    )
+    
+    # The monitor node currently working on this service, if any, and
+    # when its lease runs out (see ServiceManager.lease)
+    lease_owner = models.CharField(
+        max_length=100
+       ,null=True
+       ,blank=True
+       ,editable=False
+    )
+    
+    lease_expires_at = models.DateTimeField(
+        null=True
+       ,blank=True
+       ,editable=False
+    )
+    
+    objects = ServiceManager()
+    
     def __unicode__(self):
         return self.name
     
+    def save(self, *args, **kwargs):
+        self.update_schedule()
+        super(Service, self).save(*args, **kwargs)
+    
+    """
+    Checks that the service has a ping interval, which its schedule
+    is counted in (see ping_slot_after).
+    """
+    def clean(self):
+        if self.ping_interval_seconds is not None and self.ping_interval_seconds <= 0:
+            raise ValidationError("The ping interval seconds must be greater than 0.")
+        if not self.ping_interval_seconds and self.ping_interval_minutes is not None and self.ping_interval_minutes <= 0:
+            raise ValidationError("The ping interval minutes must be greater than 0, unless the ping interval seconds are set.")
+    
+    """
+    Recomputes next_ping_at and timeout_at from the current state.
+    A service which has never been pinged is due immediately, and only
+    an SMS request which is still awaiting a response can time out.
+    """
+    def update_schedule(self):
+        if self.last_request_date is None:
+            self.next_ping_at = datetime.datetime.now()
+        else:
+            self.next_ping_at = self.next_ping_date()
+        if self.service_type == SERVICE_MONITOR__SMS and self.ping_state == SERVICE_MONITOR__REQUEST_SENT:
+            self.timeout_at = self.timeout_date()
+        else:
+            self.timeout_at = None
+    
+    """
+    Returns the SMS to send for the current request, with the request
+    token in place of any {token} in sms_to_send.
+    """
+    def sms_text(self):
+        return self.sms_to_send.replace(SERVICE_MONITOR__TOKEN_PLACEHOLDER, self.request_token or "")
+    
+    """
+    Returns an unsaved PingLogRollup holding the totals of this
+    service's rollups of the given granularity for the periods
+    starting between start (inclusive) and end (exclusive, defaults
+    to now), e.g. for uptime and latency percentiles over 90 days.
+    """
+    def statistics(self, start, end=None, granularity=SERVICE_MONITOR__DAILY):
+        rollups = self.pinglogrollup_set.filter(granularity=granularity, period_start__gte=start)
+        if end is not None:
+            rollups = rollups.filter(period_start__lt=end)
+        total = PingLogRollup(service=self, granularity=granularity, period_start=start)
+        for rollup in rollups:
+            total.merge(rollup)
+        return total
+    
+    """
+    Returns the given latency percentiles of this service for each
+    period of the given granularity starting between start (inclusive)
+    and end (exclusive, defaults to now) in which responses were
+    received, as a list of (period start, [percentile in ms, ...]),
+    e.g. to watch the p50/p95/p99 round trip time of an SMS gateway
+    rise before requests start timing out.
+    """
+    def latency_trend(self, start, end=None, granularity=SERVICE_MONITOR__HOURLY, percentiles=(50, 95, 99)):
+        rollups = self.pinglogrollup_set.filter(granularity=granularity, period_start__gte=start, latency_count__gt=0)
+        if end is not None:
+            rollups = rollups.filter(period_start__lt=end)
+        return [(rollup.period_start, [rollup.latency_percentile_ms(percentile) for percentile in percentiles]) for rollup in rollups.order_by("period_start")]
+    
+    """
+    Returns the number of seconds between each ping of this service:
+    ping_interval_seconds if set, otherwise ping_interval_minutes.
+    """
+    def get_ping_interval_seconds(self):
+        if self.ping_interval_seconds:
+            return self.ping_interval_seconds
+        return self.ping_interval_minutes * 60
+    
+    """
+    Returns the number of seconds after which a ping request of this
+    service times out: timeout_seconds if set, otherwise
+    timeout_minutes.
+    """
+    def get_timeout_seconds(self):
+        if self.timeout_seconds:
+            return self.timeout_seconds
+        return self.timeout_minutes * 60
+    
+    """
+    Returns the offset, in seconds, of this service's pings within its
+    ping interval. It is derived from a hash of the id, so it stays
+    the same for the life of the service while services with the same
+    interval are spread evenly over it. Services whose interval is
+    given in minutes are kept on whole minutes.
+    """
+    def phase_seconds(self):
+        # Only a service saved without being validated (see clean) can have no interval
+        if self.get_ping_interval_seconds() <= 0:
+            return 0
+        offset = int(hashlib.md5(str(self.pk or 0)).hexdigest()[:8], 16)
+        if self.ping_interval_seconds:
+            return offset % self.ping_interval_seconds
+        return (offset % self.ping_interval_minutes) * 60
+    
+    """
+    Returns the date after which the next ping request can be sent, 
+    or None if a ping request has not yet been made. Pings are sent
+    at the times which are phase_seconds() past a multiple of the
+    ping interval, counted from SERVICE_MONITOR__PHASE_EPOCH, so this
+    is the first of those after the last ping request: once a service
+    is in phase, one ping interval after it.
+    """
+    def next_ping_date(self):
+        if self.last_request_date is None:
+            return None
+        else:
+            return self.ping_slot_after(self.last_request_date)
+    
+    """
+    Returns the first date after the given date at which this service
+    is due to be pinged (see next_ping_date), as a local naive date.
+    """
+    def ping_slot_after(self, date):
+        # A service without an interval is due on every run, as before intervals were phased
+        interval = max(self.get_ping_interval_seconds(), 1)
+        phase = self.phase_seconds()
+        delta = local_datetime(date) - SERVICE_MONITOR__PHASE_EPOCH
+        seconds = delta.days * 86400 + delta.seconds
+        return SERVICE_MONITOR__PHASE_EPOCH + datetime.timedelta(seconds=phase + ((seconds - phase) // interval + 1) * interval)
+
+    """
+    Returns the date after which the last ping request has timed out,
+    or None if a ping request has not yet been made.
+    """
+    def timeout_date(self):
+        if self.last_request_date is None:
+            return None
+        else:
+            return self.last_request_date + datetime.timedelta(seconds=self.get_timeout_seconds())
+
     """
     Returns True if the proper amount of time has passed since the 
     last ping request to send another ping request, otherwise False.
@@ -122,8 +476,7 @@ class Service(models.Model):
         if self.last_request_date is None:
             return True
         else:
-            delta = datetime.timedelta(minutes=self.ping_interval_minutes)
-            next_ping_time = self.last_request_date + delta
+            next_ping_time = self.next_ping_date()
             current_time = datetime.datetime.now()
             # Note: Django returns self.last_request_date as a naive datetime object, converted to the local timezone
             #       Also, datetime.datetime.now() is a naive datetime object in the local time zone
@@ -140,8 +493,7 @@ class Service(models.Model):
         if self.last_request_date is None:
             return False
         else:
-            delta = datetime.timedelta(minutes=self.timeout_minutes)
-            timeout_time = self.last_request_date + delta
+            timeout_time = self.timeout_date()
             current_time = datetime.datetime.now()
             # Note: Django returns self.last_request_date as a naive datetime object, converted to the local timezone
             #       Also, datetime.datetime.now() is a naive datetime object in the local time zone
@@ -151,6 +503,17 @@ class Service(models.Model):
 """
 All ping requests, responses, and timeouts are
 stored in the PingLog (one per entry).
+
+For HTTP responses and failures, the entry also holds the
+time spent resolving the host, connecting (including any
+TLS handshake), until the first byte of the response and 
+in total, all in milliseconds, along with the HTTP status 
+code and the number of bytes of the body read. request_ms
+is the total less the time spent setting up connections,
+which is 0 when a keep-alive connection was reused.
+
+For SMS responses, total_ms holds the round trip time from
+when the request was handed off to be sent.
 """
 class PingLog(models.Model):
     class Meta:
@@ -159,4 +522,158 @@ class PingLog(models.Model):
     service = models.ForeignKey("Service",db_index=True)
     date = models.DateTimeField(db_index=True)
     ping_state = models.IntegerField(choices=SERVICE_MONITOR__REQUEST_STATES,db_index=True)
+    dns_ms = models.IntegerField(null=True,blank=True)
+    connect_ms = models.IntegerField(null=True,blank=True)
+    ttfb_ms = models.IntegerField(null=True,blank=True)
+    total_ms = models.IntegerField(null=True,blank=True)
+    request_ms = models.IntegerField(null=True,blank=True)
+    status_code = models.SmallIntegerField(null=True,blank=True)
+    body_bytes = models.IntegerField(null=True,blank=True)
+
 
+"""
+Every PingLog entry is also counted, as it is written, in one
+PingLogRollup per service per minute, hour and day. Each rollup holds
+the number of entries in each ping state, the dates of the first and
+last of them, and the min/max/sum and a histogram of the latencies of
+the responses received, so that uptime and latency over long periods
+can be read from a few rollups instead of scanning the PingLog.
+"""
+class PingLogRollup(models.Model):
+    class Meta:
+        db_table = "service_monitor_pinglogrollup"
+        unique_together = (("service", "granularity", "period_start"),)
+    
+    service = models.ForeignKey("Service",db_index=True)
+    granularity = models.IntegerField(choices=SERVICE_MONITOR__ROLLUP_GRANULARITIES)
+    period_start = models.DateTimeField(db_index=True)
+    request_sent_count = models.IntegerField(default=0)
+    valid_response_count = models.IntegerField(default=0)
+    no_response_count = models.IntegerField(default=0)
+    invalid_response_count = models.IntegerField(default=0)
+    degraded_count = models.IntegerField(default=0)
+    first_date = models.DateTimeField(null=True,blank=True)
+    last_date = models.DateTimeField(null=True,blank=True)
+    latency_count = models.IntegerField(default=0)
+    latency_min_ms = models.IntegerField(null=True,blank=True)
+    latency_max_ms = models.IntegerField(null=True,blank=True)
+    latency_sum_ms = models.FloatField(default=0)
+    # The number of latencies falling in each of LATENCY_BUCKETS_MS, comma separated
+    latency_histogram = models.CommaSeparatedIntegerField(max_length=500,blank=True)
+    
+    # The count field for each ping state
+    COUNT_FIELDS = {
+        SERVICE_MONITOR__REQUEST_SENT: "request_sent_count"
+       ,SERVICE_MONITOR__VALID_RESPONSE_RECEIVED: "valid_response_count"
+       ,SERVICE_MONITOR__NO_RESPONSE: "no_response_count"
+       ,SERVICE_MONITOR__INVALID_RESPONSE_RECEIVED: "invalid_response_count"
+       ,SERVICE_MONITOR__DEGRADED: "degraded_count"
+    }
+    
+    # The upper bound (in milliseconds) of each bucket of the latency
+    # histogram; the last bucket holds everything above the last bound
+    LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000)
+    
+    """
+    Returns the start of the period of the given granularity which
+    contains the given local naive date.
+    """
+    @staticmethod
+    def period_start_for(granularity, date):
+        if granularity == SERVICE_MONITOR__MINUTE:
+            return date.replace(second=0, microsecond=0)
+        elif granularity == SERVICE_MONITOR__HOURLY:
+            return date.replace(minute=0, second=0, microsecond=0)
+        else:
+            return date.replace(hour=0, minute=0, second=0, microsecond=0)
+    
+    def get_histogram(self):
+        if self.latency_histogram:
+            return [int(count) for count in self.latency_histogram.split(",")]
+        else:
+            return [0] * (len(self.LATENCY_BUCKETS_MS) + 1)
+    
+    def set_histogram(self, histogram):
+        self.latency_histogram = ",".join([str(count) for count in histogram])
+    
+    """
+    Counts an entry with the given ping state, local naive date and,
+    for responses, latency in milliseconds in this rollup.
+    """
+    def add(self, ping_state, date, latency_ms=None):
+        field_name = self.COUNT_FIELDS[ping_state]
+        setattr(self, field_name, getattr(self, field_name) + 1)
+        if self.first_date is None or date < self.first_date:
+            self.first_date = date
+        if self.last_date is None or date > self.last_date:
+            self.last_date = date
+        if latency_ms is not None:
+            latency_ms = int(round(latency_ms))
+            self.latency_count += 1
+            self.latency_sum_ms += latency_ms
+            if self.latency_min_ms is None or latency_ms < self.latency_min_ms:
+                self.latency_min_ms = latency_ms
+            if self.latency_max_ms is None or latency_ms > self.latency_max_ms:
+                self.latency_max_ms = latency_ms
+            histogram = self.get_histogram()
+            histogram[bisect.bisect_left(self.LATENCY_BUCKETS_MS, latency_ms)] += 1
+            self.set_histogram(histogram)
+    
+    """
+    Adds the counts and latencies of another rollup to this one.
+    """
+    def merge(self, other):
+        for field_name in self.COUNT_FIELDS.values() + ["latency_count", "latency_sum_ms"]:
+            setattr(self, field_name, getattr(self, field_name) + getattr(other, field_name))
+        for field_name, choose in (("first_date", min), ("last_date", max), ("latency_min_ms", min), ("latency_max_ms", max)):
+            values = [value for value in (getattr(self, field_name), getattr(other, field_name)) if value is not None]
+            if values:
+                setattr(self, field_name, choose(values))
+        self.set_histogram([a + b for a, b in zip(self.get_histogram(), other.get_histogram())])
+    
+    """
+    Returns the fraction of completed requests which received a valid
+    response (degraded or not), or None if there were none.
+    """
+    def success_ratio(self):
+        succeeded = self.valid_response_count + self.degraded_count
+        completed = succeeded + self.no_response_count + self.invalid_response_count
+        if completed == 0:
+            return None
+        return float(succeeded) / completed
+    
+    def latency_mean_ms(self):
+        if self.latency_count == 0:
+            return None
+        return self.latency_sum_ms / self.latency_count
+    
+    """
+    Returns an estimate of the given percentile (0-100) of the latencies
+    in milliseconds, interpolated within the histogram bucket it falls
+    in, or None if no latencies were recorded.
+    """
+    def latency_percentile_ms(self, percentile):
+        if self.latency_count == 0:
+            return None
+        rank = self.latency_count * percentile / 100.0
+        seen = 0
+        bounds = (0,) + self.LATENCY_BUCKETS_MS + (self.latency_max_ms,)
+        for i, count in enumerate(self.get_histogram()):
+            if count and seen + count >= rank:
+                lower, upper = bounds[i], max(bounds[i], bounds[i + 1])
+                estimate = lower + (upper - lower) * (rank - seen) / count
+                return min(max(estimate, self.latency_min_ms), self.latency_max_ms)
+            seen += count
+        return self.latency_max_ms
+
+"""
+Records the date from which PingLog entries have been counted in the
+rollups as they were written. Entries older than this were written
+before the rollups were kept up to date, and are counted in them when
+they are pruned instead (see retention.py). There is only ever one.
+"""
+class PingLogRollupStart(models.Model):
+    class Meta:
+        db_table = "service_monitor_pinglogrollupstart"
+    
+    date = models.DateTimeField()
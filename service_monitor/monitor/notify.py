@@ -0,0 +1,174 @@
+import atexit
+import datetime
+import logging
+import smtplib
+import threading
+import time
+
+from django.core.mail import EmailMessage, get_connection
+from django.conf import settings
+
+# How long a notification is held so that other notifications for the
+# same recipient can be sent with it in a single digest email
+SERVICE_MONITOR_NOTIFICATION_DIGEST_SECONDS = getattr(settings, "SERVICE_MONITOR_NOTIFICATION_DIGEST_SECONDS", 60)
+
+# The number of seconds to wait before retrying after the mail server failed
+RETRY_SECONDS = 60
+
+# The errors with which the mail server rejects a single email, such as
+# a refused recipient, which retrying the email would not fix
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+logger = logging.getLogger("monitor.notify")
+
+"""
+An outbound queue of notification emails, delivered by a background
+thread so that probing never waits on the mail server.
+
+Notifications are queued per recipient. Once the oldest notification
+for a recipient has been waiting for digest_seconds, everything queued
+for that recipient is sent as one email: the notification itself if
+there is only one, otherwise a digest of all of them. All emails due
+at the same time are sent through a single SMTP connection. Emails
+which cannot be sent because the mail server cannot be reached are
+put back on the queue and retried a minute later, while emails the
+mail server rejects (see MESSAGE_ERRORS) are logged and dropped.
+"""
+class NotificationQueue(object):
+    def __init__(self, digest_seconds=None):
+        if digest_seconds is None:
+            digest_seconds = SERVICE_MONITOR_NOTIFICATION_DIGEST_SECONDS
+        self.digest_seconds = digest_seconds
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.thread = None
+
+    """
+    Queues a notification with the given subject and body for each of
+    the given recipients, and returns immediately.
+    """
+    def send(self, subject, body, recipients):
+        now = datetime.datetime.now()
+        self.condition.acquire()
+        try:
+            for recipient in recipients:
+                recipient = recipient.strip()
+                if recipient:
+                    self.pending.setdefault(recipient, []).append((now, subject, body))
+            if self.thread is None or not self.thread.isAlive():
+                self.thread = threading.Thread(target=self.deliver_forever, name="monitor.notify")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    """
+    Removes and returns the notifications for the recipients whose
+    oldest notification is due at the given date (all of them if
+    everything is true), as a list of (recipient, notifications).
+    """
+    def pop_due(self, now, everything=False):
+        window = datetime.timedelta(seconds=self.digest_seconds)
+        due = []
+        for recipient, notifications in self.pending.items():
+            if everything or now - notifications[0][0] >= window:
+                due.append((recipient, self.pending.pop(recipient)))
+        return due
+
+    """
+    Returns the number of seconds until the next recipient is due, or
+    None if nothing is queued.
+    """
+    def seconds_until_due(self, now):
+        if not self.pending:
+            return None
+        oldest = min([notifications[0][0] for notifications in self.pending.values()])
+        delta = oldest + datetime.timedelta(seconds=self.digest_seconds) - now
+        return max(0, delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0)
+
+    def deliver_forever(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while True:
+                    now = datetime.datetime.now()
+                    due = self.pop_due(now)
+                    if due:
+                        break
+                    self.condition.wait(self.seconds_until_due(now))
+            finally:
+                self.condition.release()
+            if not self.deliver(due):
+                # Give the mail server a while before retrying
+                time.sleep(RETRY_SECONDS)
+
+    """
+    Sends everything still queued right away, e.g. on shutdown.
+    """
+    def flush(self):
+        self.condition.acquire()
+        try:
+            due = self.pop_due(datetime.datetime.now(), everything=True)
+        finally:
+            self.condition.release()
+        self.deliver(due)
+
+    """
+    Sends the given list of (recipient, notifications), one email per
+    recipient, through a single SMTP connection. Returns False if the
+    connection failed before all of them were sent, in which case those
+    which were not sent are queued again. Emails rejected by the mail
+    server are dropped, so that they do not hold up the others.
+    """
+    def deliver(self, due):
+        if not due:
+            return True
+        messages = [digest_email(recipient, notifications) for recipient, notifications in due]
+        sent = 0
+        connection = get_connection()
+        try:
+            connection.open()
+            try:
+                # Sent one at a time, so that a failure partway through only retries the emails which were not sent
+                for message in messages:
+                    try:
+                        connection.send_messages([message])
+                    except MESSAGE_ERRORS:
+                        logger.exception("The mail server rejected the notification email to %s, dropping it" % ", ".join(message.to))
+                    sent += 1
+            finally:
+                connection.close()
+        except Exception:
+            if sent < len(messages):
+                logger.exception("Could not send %s of %s notification email(s), will retry" % (len(messages) - sent, len(messages)))
+                self.condition.acquire()
+                try:
+                    for recipient, notifications in due[sent:]:
+                        self.pending[recipient] = notifications + self.pending.get(recipient, [])
+                finally:
+                    self.condition.release()
+                return False
+            # Everything went out before the connection failed to close
+            logger.exception("Could not close the connection to the mail server")
+        return True
+
+"""
+Returns the EmailMessage for the given list of (date, subject, body)
+notifications for the given recipient.
+"""
+def digest_email(recipient, notifications):
+    if len(notifications) == 1:
+        date, subject, body = notifications[0]
+    else:
+        subject = "Service Monitor: %s notifications" % len(notifications)
+        body = "\n\n".join(["%s\n%s\n%s" % (date.strftime("%Y-%m-%d %H:%M:%S"), notification_subject, notification_body) for date, notification_subject, notification_body in notifications])
+    return EmailMessage(
+        subject = subject
+       ,body = body
+       ,to = [recipient]
+    )
+
+# The queue shared by everything running in this process
+notifications = NotificationQueue()
+atexit.register(notifications.flush)
@@ -0,0 +1,182 @@
+import datetime
+import heapq
+import logging
+import pytz
+import random
+import threading
+import time
+
+from .models import *
+from .lookup import service_index
+from .config import service_config
+from .writer import writer
+from rapidsms.contrib.messaging.utils import send_message
+from django.conf import settings
+
+# The number of SMS requests which may be handed to each backend per minute
+SERVICE_MONITOR_SMS_PER_MINUTE = getattr(settings, "SERVICE_MONITOR_SMS_PER_MINUTE", 30)
+
+# The number of SMS requests which may be handed to each backend at once
+# before the rate above applies
+SERVICE_MONITOR_SMS_BURST = getattr(settings, "SERVICE_MONITOR_SMS_BURST", 5)
+
+# Each SMS request is held back for a random number of seconds up to this
+# many, so that the requests due in the same run are spread out
+SERVICE_MONITOR_SMS_JITTER_SECONDS = getattr(settings, "SERVICE_MONITOR_SMS_JITTER_SECONDS", 30)
+
+logger = logging.getLogger("monitor.outbox")
+
+"""
+A token bucket allowing a burst of capacity sends, refilled at rate
+sends per second.
+"""
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+
+    """
+    Takes a token if one is available and returns 0, otherwise returns
+    the number of seconds until one will be.
+    """
+    def take(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+"""
+An outbound queue of SMS requests, handed to their backends by a
+background thread. Each request is held back by a random jitter of up
+to SERVICE_MONITOR_SMS_JITTER_SECONDS, and each backend is sent at
+most SERVICE_MONITOR_SMS_PER_MINUTE requests per minute (after an
+initial burst of SERVICE_MONITOR_SMS_BURST), so that services which
+share an interval do not all go out at once and get throttled by the
+modem or gateway.
+
+While a request is queued, its service is leased and left in the
+SERVICE_MONITOR__REQUEST_QUEUED state, which never times out. The
+request state (the last request date, and with it the timeout, and the
+SERVICE_MONITOR__REQUEST_SENT ping state), the "request sent" PingLog
+entry and the date the round trip time is measured from are all
+written when the request is actually handed to the backend, not when
+it is queued, and the lease is released once they are. Requests lost
+with the process are queued again by requeue() (see tasks.py) when
+the router starts.
+"""
+class SmsOutbox(object):
+    def __init__(self, per_minute=None, burst=None, jitter_seconds=None):
+        self.rate = (per_minute or SERVICE_MONITOR_SMS_PER_MINUTE) / 60.0
+        self.burst = burst or SERVICE_MONITOR_SMS_BURST
+        if jitter_seconds is None:
+            jitter_seconds = SERVICE_MONITOR_SMS_JITTER_SECONDS
+        self.jitter_seconds = jitter_seconds
+        self.condition = threading.Condition()
+        self.queue = []
+        self.queued = {}
+        self.buckets = {}
+        self.thread = None
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __contains__(self, service_id):
+        return service_id in self.queued
+
+    """
+    Moves the last request date of the queued request of the given
+    service to the one given, so that it is kept when the request is
+    handed off.
+    """
+    def fold(self, service):
+        self.condition.acquire()
+        try:
+            if service.pk in self.queued:
+                self.queued[service.pk].last_request_date = service.last_request_date
+        finally:
+            self.condition.release()
+
+    """
+    Queues the SMS request of the given service, which has been leased
+    and marked as SERVICE_MONITOR__REQUEST_QUEUED. If rollup_only is
+    true, its PingLog entry is only counted in the rollups (see
+    PingLogWriter.log).
+    """
+    def send(self, service, rollup_only=False):
+        send_at = time.time() + random.uniform(0, self.jitter_seconds)
+        backend_id = service_config.connection(service).backend_id
+        self.condition.acquire()
+        try:
+            heapq.heappush(self.queue, (send_at, service.pk, backend_id, service, rollup_only))
+            self.queued[service.pk] = service
+            if self.thread is None or not self.thread.isAlive():
+                self.thread = threading.Thread(target=self.send_forever, name="monitor.outbox")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    """
+    Removes and returns the next request which can be handed to its
+    backend, waiting until there is one.
+    """
+    def pop(self):
+        self.condition.acquire()
+        try:
+            while True:
+                now = time.time()
+                if self.queue and self.queue[0][0] <= now:
+                    send_at, service_id, backend_id, service, rollup_only = heapq.heappop(self.queue)
+                    if backend_id not in self.buckets:
+                        self.buckets[backend_id] = TokenBucket(self.rate, self.burst)
+                    wait = self.buckets[backend_id].take(now)
+                    if wait == 0:
+                        self.queued.pop(service_id, None)
+                        return (service, rollup_only)
+                    # The backend is at its rate limit, so try again once it has a token
+                    heapq.heappush(self.queue, (now + wait, service_id, backend_id, service, rollup_only))
+                elif self.queue:
+                    self.condition.wait(self.queue[0][0] - now)
+                else:
+                    self.condition.wait()
+        finally:
+            self.condition.release()
+
+    def send_forever(self):
+        while True:
+            service, rollup_only = self.pop()
+            try:
+                send_message(service_config.connection(service), service.sms_text())
+            except Exception:
+                # The request is still marked as sent, so that it times out and is alerted on like one which got no reply
+                logger.exception("Could not send the SMS request for service %s" % service.pk)
+            try:
+                self.hand_off(service, datetime.datetime.now(tz=pytz.utc), rollup_only)
+            except Exception:
+                logger.exception("Could not record the SMS request for service %s" % service.pk)
+
+    """
+    Writes the request state of the given service, whose request was
+    handed to its backend at the given date, and releases its lease.
+    """
+    def hand_off(self, service, date, rollup_only=False):
+        # The request date is moved to when the request was handed off, so its timeout is counted from then, unless
+        # the request is one of several being caught up on (see catch_up), which keeps the ping slot it was sent for
+        if service.last_request_date is None or service.ping_slot_after(date) == service.ping_slot_after(service.last_request_date):
+            service.last_request_date = date
+        service.ping_state = SERVICE_MONITOR__REQUEST_SENT
+        writer.save(service, "last_request_date", "ping_state")
+        service_index.sent(service, date)
+        writer.log(service, date, ping_state=SERVICE_MONITOR__REQUEST_SENT, rollup_only=rollup_only)
+
+        # The state is written before the lease is released, so that no other node sees the request as still queued
+        writer.flush()
+        Service.objects.release([service.pk])
+
+# The outbox shared by everything running in this process
+outbox = SmsOutbox()
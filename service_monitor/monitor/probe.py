@@ -0,0 +1,632 @@
+import datetime
+import httplib
+import math
+import pytz
+import re
+import socket
+import ssl
+import threading
+import time
+import urllib2
+import urlparse
+
+from collections import deque
+from .models import SERVICE_MONITOR__DEGRADED, SERVICE_MONITOR__HEAD
+from django.conf import settings
+
+# The maximum number of probes in flight at once, across all hosts
+SERVICE_MONITOR_MAX_CONCURRENT_PROBES = getattr(settings, "SERVICE_MONITOR_MAX_CONCURRENT_PROBES", 50)
+
+# The maximum number of probes in flight at once against any single host
+SERVICE_MONITOR_MAX_PROBES_PER_HOST = getattr(settings, "SERVICE_MONITOR_MAX_PROBES_PER_HOST", 4)
+
+# The maximum number of redirects followed by a probe
+SERVICE_MONITOR_MAX_REDIRECTS = getattr(settings, "SERVICE_MONITOR_MAX_REDIRECTS", 5)
+
+# The maximum number of idle keep-alive connections kept open per host
+SERVICE_MONITOR_MAX_IDLE_CONNECTIONS_PER_HOST = getattr(settings, "SERVICE_MONITOR_MAX_IDLE_CONNECTIONS_PER_HOST", SERVICE_MONITOR_MAX_PROBES_PER_HOST)
+
+# The number of seconds after which an idle keep-alive connection is closed
+SERVICE_MONITOR_IDLE_CONNECTION_SECONDS = getattr(settings, "SERVICE_MONITOR_IDLE_CONNECTION_SECONDS", 30)
+
+# The number of seconds a probe may take to connect (including any TLS
+# handshake), unless the service sets its own connect timeout
+SERVICE_MONITOR_CONNECT_TIMEOUT_SECONDS = getattr(settings, "SERVICE_MONITOR_CONNECT_TIMEOUT_SECONDS", 10)
+
+# The number of seconds a probe may wait for each read from the server,
+# unless the service sets its own read timeout
+SERVICE_MONITOR_READ_TIMEOUT_SECONDS = getattr(settings, "SERVICE_MONITOR_READ_TIMEOUT_SECONDS", 30)
+
+# Whether HTTPS probes check the certificate and host name of the server
+# against the system's CA certificates; set to False to monitor servers
+# with self-signed certificates (the host name is sent as SNI either way)
+SERVICE_MONITOR_VERIFY_CERTIFICATES = getattr(settings, "SERVICE_MONITOR_VERIFY_CERTIFICATES", True)
+
+# The number of consecutive probes of a host which must fail to connect
+# or time out before its circuit breaker opens
+SERVICE_MONITOR_CIRCUIT_FAILURES = getattr(settings, "SERVICE_MONITOR_CIRCUIT_FAILURES", 5)
+
+# The number of seconds an open circuit breaker waits before letting a
+# single trial probe through; doubled after each failed trial
+SERVICE_MONITOR_CIRCUIT_BACKOFF_SECONDS = getattr(settings, "SERVICE_MONITOR_CIRCUIT_BACKOFF_SECONDS", 30)
+
+# The maximum number of seconds an open circuit breaker waits between trials
+SERVICE_MONITOR_CIRCUIT_MAX_BACKOFF_SECONDS = getattr(settings, "SERVICE_MONITOR_CIRCUIT_MAX_BACKOFF_SECONDS", 30 * 60)
+
+"""
+Returns the key used to group urls for the per-host concurrency cap.
+"""
+def host_key(url):
+    return urlparse.urlsplit(url or "")[1].lower()
+
+"""
+Returns the SSL context HTTPS probes are made with, which checks the
+certificate and host name of the server unless
+SERVICE_MONITOR_VERIFY_CERTIFICATES is False.
+"""
+def create_ssl_context():
+    context = ssl.create_default_context()
+    if not SERVICE_MONITOR_VERIFY_CERTIFICATES:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+# The SSL context shared by everything running in this process
+ssl_context = create_ssl_context()
+
+"""
+Raised for a 2xx response whose body does not match the service's
+valid_body_regex.
+"""
+class InvalidResponseError(urllib2.URLError):
+    pass
+
+"""
+Set as the error of a probe which was not sent because the circuit
+breaker of its host is open.
+"""
+class CircuitOpenError(urllib2.URLError):
+    pass
+
+"""
+The outcome of probing a single service. If the probe succeeded,
+error is None; otherwise it holds the exception that was raised
+(normally a urllib2.URLError or urllib2.HTTPError).
+
+Whatever was measured before the probe finished or failed is kept
+in the timing attributes, all in milliseconds: dns_ms (resolving the
+host), connect_ms (connecting, including any TLS handshake), ttfb_ms
+(from the start of the probe until the response headers were read)
+and total_ms, along with the status_code and body_bytes of the last
+response read (see Service.max_body_bytes). dns_ms and connect_ms
+add up all redirects followed, and are 0 when a pooled connection
+was reused. request_ms is total_ms less the time spent setting up
+connections.
+"""
+class ProbeResult(object):
+    TIMING_FIELDS = ("dns_ms", "connect_ms", "ttfb_ms", "total_ms", "request_ms", "status_code", "body_bytes")
+
+    def __init__(self, service):
+        self.service = service
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.body = ""
+        for field_name in self.TIMING_FIELDS:
+            setattr(self, field_name, None)
+
+    def succeeded(self):
+        return self.error is None
+
+    def invalid(self):
+        return isinstance(self.error, InvalidResponseError)
+
+    """
+    Returns True if the host could not be reached at all, as opposed
+    to responding with an error or an invalid body.
+    """
+    def unreachable(self):
+        return isinstance(self.error, urllib2.URLError) and not isinstance(self.error, (urllib2.HTTPError, InvalidResponseError, CircuitOpenError))
+
+    def latency_ms(self):
+        return self.total_ms
+
+    """
+    Returns the measurements as keyword arguments for a PingLog entry.
+    """
+    def timings(self):
+        return dict([(field_name, getattr(self, field_name)) for field_name in self.TIMING_FIELDS])
+
+def elapsed_ms(start):
+    return int(round((time.time() - start) * 1000))
+
+"""
+The wall clock deadline of a probe, the given number of seconds
+from now. Every connect and read of the probe is given the smaller
+of its own timeout and the time left, and a watchdog shuts the
+connection down when the deadline passes, so that a server which
+trickles bytes cannot keep a probe going past it.
+"""
+class Deadline(object):
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds
+
+    def expired(self):
+        return time.time() >= self.expires
+
+    """
+    Returns the given timeout, capped at the time left. Raises
+    socket.timeout if the deadline has passed.
+    """
+    def timeout(self, limit):
+        remaining = self.expires - time.time()
+        if remaining <= 0:
+            raise socket.timeout("deadline exceeded")
+        return min(limit, remaining)
+
+    """
+    Starts and returns a timer which shuts the given socket down when
+    the deadline passes. The caller must cancel it when done.
+    """
+    def watch(self, sock):
+        def shutdown():
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        timer = threading.Timer(max(0, self.expires - time.time()), shutdown)
+        timer.setDaemon(True)
+        timer.start()
+        return timer
+
+"""
+A pool of idle keep-alive HTTP connections, keyed on (scheme, host,
+port). At most max_idle_per_host connections are kept per key, and
+connections idle for longer than idle_seconds are closed.
+"""
+class ConnectionPool(object):
+    def __init__(self, max_idle_per_host=None, idle_seconds=None):
+        self.max_idle_per_host = max_idle_per_host or SERVICE_MONITOR_MAX_IDLE_CONNECTIONS_PER_HOST
+        self.idle_seconds = idle_seconds or SERVICE_MONITOR_IDLE_CONNECTION_SECONDS
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    """
+    Returns an idle connection for the given key, or None if there is
+    none.
+    """
+    def get(self, key):
+        self.evict()
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop()[1]
+            return None
+        finally:
+            self.lock.release()
+
+    """
+    Returns a connection whose response has been fully read to the
+    pool, or closes it if the pool for its key is full.
+    """
+    def put(self, key, connection):
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append((time.time(), connection))
+                connection = None
+        finally:
+            self.lock.release()
+        if connection is not None:
+            connection.close()
+
+    """
+    Closes all connections which have been idle for too long.
+    """
+    def evict(self):
+        expired = []
+        self.lock.acquire()
+        try:
+            cutoff = time.time() - self.idle_seconds
+            for key, connections in self.idle.items():
+                expired.extend([connection for idle_since, connection in connections if idle_since < cutoff])
+                connections[:] = [(idle_since, connection) for idle_since, connection in connections if idle_since >= cutoff]
+                if not connections:
+                    del self.idle[key]
+        finally:
+            self.lock.release()
+        for connection in expired:
+            connection.close()
+
+# The pool shared by everything running in this process
+connection_pool = ConnectionPool()
+
+"""
+A circuit breaker per host. Once failures consecutive probes of a
+host have been unable to reach it, the breaker opens and the probes
+of every service on the host fail straight away without sending a
+request. After backoff_seconds a single trial probe is let through:
+if it reaches the host the breaker closes again, otherwise it stays
+open for twice as long (up to max_backoff_seconds) before the next
+trial. A large outage then costs a few probes instead of one hung
+connection per service per run.
+"""
+class CircuitBreaker(object):
+    def __init__(self, failures=None, backoff_seconds=None, max_backoff_seconds=None):
+        self.failures = failures or SERVICE_MONITOR_CIRCUIT_FAILURES
+        self.backoff_seconds = backoff_seconds or SERVICE_MONITOR_CIRCUIT_BACKOFF_SECONDS
+        self.max_backoff_seconds = max_backoff_seconds or SERVICE_MONITOR_CIRCUIT_MAX_BACKOFF_SECONDS
+        self.lock = threading.Lock()
+        self.failure_counts = {}
+        self.backoffs = {}
+        self.open_until = {}
+        self.trials = set()
+
+    def is_open(self, host):
+        return host in self.open_until
+
+    """
+    Returns True if a probe of the given host may be sent, i.e. its
+    breaker is closed or it is time for a trial probe.
+    """
+    def allow(self, host, now=None):
+        now = now or time.time()
+        self.lock.acquire()
+        try:
+            if host not in self.open_until:
+                return True
+            if now < self.open_until[host] or host in self.trials:
+                return False
+            self.trials.add(host)
+            return True
+        finally:
+            self.lock.release()
+
+    """
+    Records whether a probe of the given host which was allowed
+    through reached it.
+    """
+    def record(self, host, reached, now=None):
+        now = now or time.time()
+        self.lock.acquire()
+        try:
+            if reached:
+                self.failure_counts.pop(host, None)
+                self.backoffs.pop(host, None)
+                self.open_until.pop(host, None)
+                self.trials.discard(host)
+            elif host in self.trials:
+                self.trials.discard(host)
+                self.backoffs[host] = min(self.backoffs[host] * 2, self.max_backoff_seconds)
+                self.open_until[host] = now + self.backoffs[host]
+            elif host not in self.open_until:
+                self.failure_counts[host] = self.failure_counts.get(host, 0) + 1
+                if self.failure_counts[host] >= self.failures:
+                    self.backoffs[host] = self.backoff_seconds
+                    self.open_until[host] = now + self.backoffs[host]
+        finally:
+            self.lock.release()
+
+# The circuit breakers shared by everything running in this process
+circuit_breaker = CircuitBreaker()
+
+"""
+Probes batches of HTTP services concurrently using a bounded pool
+of worker threads. At most max_concurrent probes are in flight at
+once, and at most max_per_host of those target the same host, so a
+tick takes roughly as long as the slowest single probe. The caps
+hold across all batches probed through the same engine at once,
+such as those probed in the background by the probe loop.
+
+The worker threads only do network I/O; all database access is left
+to the caller, which runs in the calling thread. Keep-alive
+connections are shared across probes and runs through a
+ConnectionPool, and hosts which cannot be reached are skipped by a
+CircuitBreaker.
+"""
+class ProbeEngine(object):
+    def __init__(self, max_concurrent=None, max_per_host=None, pool=None, breaker=None):
+        self.max_concurrent = max_concurrent or SERVICE_MONITOR_MAX_CONCURRENT_PROBES
+        self.max_per_host = max_per_host or SERVICE_MONITOR_MAX_PROBES_PER_HOST
+        self.pool = pool or connection_pool
+        self.breaker = breaker or circuit_breaker
+        # The number of probes in flight, in total and per host, across all batches
+        self.condition = threading.Condition()
+        self.running = 0
+        self.in_flight = {}
+
+    """
+    Probes a single service and returns its ProbeResult. If the
+    circuit breaker of its host is open, the probe fails with a
+    CircuitOpenError without sending anything.
+    """
+    def probe_one(self, service):
+        result = ProbeResult(service)
+        result.started = datetime.datetime.now(tz=pytz.utc)
+        start = time.time()
+        host = host_key(service.url)
+        if not self.breaker.allow(host):
+            result.error = CircuitOpenError("Circuit breaker open for host %s" % host)
+            result.total_ms = 0
+            result.finished = result.started
+            return result
+        try:
+            self.fetch(service.url, Deadline(service.get_timeout_seconds()), start, result)
+        except Exception, e:
+            result.error = e
+        self.breaker.record(host, not result.unreachable())
+        result.total_ms = elapsed_ms(start)
+        result.request_ms = result.total_ms - (result.dns_ms or 0) - (result.connect_ms or 0)
+        result.finished = datetime.datetime.now(tz=pytz.utc)
+        return result
+
+    """
+    Requests the given url, following redirects, and reads the whole
+    response while recording the timings in the result, all before the
+    given Deadline. Like urlopen,
+    raises urllib2.HTTPError for responses other than 2xx and wraps
+    network errors in urllib2.URLError.
+
+    Connections are taken from and returned to the pool when the
+    server allows keep-alive. A request which fails on a reused
+    connection (which the server may have closed in the meantime) is
+    retried once on a new connection.
+    """
+    def fetch(self, url, deadline, start, result):
+        result.dns_ms = 0
+        result.connect_ms = 0
+        for redirect in range(SERVICE_MONITOR_MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ("http", "https"):
+                raise urllib2.URLError("unknown url type: %s" % parts.scheme)
+            key = (parts.scheme, parts.hostname, parts.port)
+
+            connection = self.pool.get(key)
+            try:
+                if connection is None:
+                    connection = self.connect(parts, deadline, result)
+                    response = self.request(connection, parts, deadline, start, result)
+                else:
+                    try:
+                        response = self.request(connection, parts, deadline, start, result)
+                    except (socket.error, httplib.HTTPException):
+                        if deadline.expired():
+                            raise
+                        connection.close()
+                        connection = self.connect(parts, deadline, result)
+                        response = self.request(connection, parts, deadline, start, result)
+            except (socket.error, ssl.SSLError, ssl.CertificateError, httplib.HTTPException), e:
+                if connection is not None:
+                    connection.close()
+                raise urllib2.URLError(e)
+
+            # Connections whose response was not read to the end cannot be reused
+            if response.will_close or not response.isclosed():
+                connection.close()
+            else:
+                self.pool.put(key, connection)
+
+            location = response.getheader("location")
+            if 300 <= response.status < 400 and location:
+                url = urlparse.urljoin(url, location)
+            elif 200 <= response.status < 300:
+                if result.service.valid_body_regex and not re.search(result.service.valid_body_regex, result.body):
+                    raise InvalidResponseError("Response body does not match '%s'" % result.service.valid_body_regex)
+                return
+            else:
+                raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+        raise urllib2.HTTPError(url, response.status, "Too many redirects", response.msg, None)
+
+    """
+    Opens a new connection for the given split url, recording the time
+    spent resolving the host and connecting in the result. Connecting
+    and the TLS handshake are limited by the service's connect timeout.
+    """
+    def connect(self, parts, deadline, result):
+        if parts.scheme == "https":
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        port = parts.port or connection_class.default_port
+
+        step = time.time()
+        address = socket.getaddrinfo(parts.hostname, port, 0, socket.SOCK_STREAM)[0][4]
+        result.dns_ms += elapsed_ms(step)
+
+        step = time.time()
+        timeout = deadline.timeout(result.service.connect_timeout_seconds or SERVICE_MONITOR_CONNECT_TIMEOUT_SECONDS)
+        sock = socket.create_connection(address[:2], timeout)
+        if parts.scheme == "https":
+            try:
+                sock = ssl_context.wrap_socket(sock, server_hostname=parts.hostname)
+            except:
+                sock.close()
+                raise
+        result.connect_ms += elapsed_ms(step)
+
+        # The socket is already open, so the connection object only does the HTTP
+        connection = connection_class(parts.hostname, port)
+        connection.sock = sock
+        return connection
+
+    """
+    Sends a GET or HEAD (depending on the service's http_method) for
+    the given split url on the given connection and reads the response
+    body, up to the service's max_body_bytes if set, recording the time
+    to the first byte, the status code, the size of the body read and
+    the body itself if the service has a valid_body_regex in the result.
+    Each read is limited by the service's read timeout, and the whole
+    request by the deadline.
+    """
+    def request(self, connection, parts, deadline, start, result):
+        service = result.service
+        if service.http_method == SERVICE_MONITOR__HEAD:
+            method = "HEAD"
+        else:
+            method = "GET"
+        read_timeout = service.read_timeout_seconds or SERVICE_MONITOR_READ_TIMEOUT_SECONDS
+        # The underlying socket, which stays open for reading the response
+        # even when httplib closes the connection's socket object
+        sock = getattr(connection.sock, "_sock", connection.sock)
+        watchdog = deadline.watch(sock)
+        try:
+            sock.settimeout(deadline.timeout(read_timeout))
+            connection.request(method, urlparse.urlunsplit(("", "", parts.path or "/", parts.query, "")), headers={"User-Agent": "service-monitor"})
+            response = connection.getresponse()
+            result.ttfb_ms = elapsed_ms(start)
+            result.status_code = response.status
+            result.body_bytes = 0
+            body = []
+            while service.max_body_bytes is None or result.body_bytes < service.max_body_bytes:
+                size = 8192
+                if service.max_body_bytes is not None:
+                    size = min(size, service.max_body_bytes - result.body_bytes)
+                sock.settimeout(deadline.timeout(read_timeout))
+                chunk = response.read(size)
+                if not chunk:
+                    break
+                result.body_bytes += len(chunk)
+                if service.valid_body_regex:
+                    body.append(chunk)
+        finally:
+            watchdog.cancel()
+        # A response cut short by the watchdog looks like a complete one
+        if deadline.expired():
+            raise socket.timeout("deadline exceeded")
+        result.body = "".join(body)
+        return response
+
+    """
+    Probes all of the given services and returns a list of
+    ProbeResults in the same order as the services.
+    """
+    def probe(self, services):
+        services = list(services)
+        results = [None] * len(services)
+        if not services:
+            return results
+
+        pending = list(enumerate(services))
+        condition = self.condition
+        in_flight = self.in_flight
+
+        # Pop the first pending job whose host is below its cap, or
+        # return None if every probe slot is taken or every pending
+        # job's host is saturated. Must be called with the condition held.
+        def next_job():
+            if self.running >= self.max_concurrent:
+                return None
+            for i in range(len(pending)):
+                index, service = pending[i]
+                host = host_key(service.url)
+                if in_flight.get(host, 0) < self.max_per_host:
+                    del pending[i]
+                    in_flight[host] = in_flight.get(host, 0) + 1
+                    self.running += 1
+                    return (index, service, host)
+            return None
+
+        def worker():
+            while True:
+                condition.acquire()
+                try:
+                    job = next_job()
+                    while job is None and pending:
+                        condition.wait()
+                        job = next_job()
+                finally:
+                    condition.release()
+                if job is None:
+                    return
+
+                index, service, host = job
+                try:
+                    results[index] = self.probe_one(service)
+                finally:
+                    condition.acquire()
+                    try:
+                        in_flight[host] -= 1
+                        if not in_flight[host]:
+                            del in_flight[host]
+                        self.running -= 1
+                        condition.notifyAll()
+                    finally:
+                        condition.release()
+
+        threads = []
+        for i in range(min(self.max_concurrent, len(services))):
+            thread = threading.Thread(target=worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+# The engine shared by everything running in this process
+probe_engine = ProbeEngine()
+
+"""
+Keeps a rolling window of the latencies of the last responses of
+each service in memory, and decides from it whether each service is
+degraded, i.e. whether the service's latency_slo_percentile of the
+window exceeds its latency_slo_ms.
+"""
+class LatencyTracker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.degraded = {}
+
+    """
+    Starts tracking the given service from its saved state, if it is
+    not being tracked yet. Must be called before its state changes.
+    """
+    def seed(self, service):
+        self.lock.acquire()
+        try:
+            if service.pk not in self.degraded:
+                self.degraded[service.pk] = (service.ping_state == SERVICE_MONITOR__DEGRADED)
+        finally:
+            self.lock.release()
+
+    """
+    Adds the latency of a response to the window of the given service.
+    Returns a tuple (was degraded, is degraded). Until the window is
+    full, the service stays as it was.
+    """
+    def observe(self, service, latency_ms):
+        self.lock.acquire()
+        try:
+            was_degraded = self.degraded.get(service.pk, False)
+            if not service.latency_slo_ms:
+                self.degraded[service.pk] = False
+                return (was_degraded, False)
+
+            window = self.windows.get(service.pk)
+            if window is None or window.maxlen != service.latency_slo_window:
+                window = deque(window or [], service.latency_slo_window)
+                self.windows[service.pk] = window
+            window.append(latency_ms)
+
+            if len(window) == window.maxlen:
+                self.degraded[service.pk] = (self.percentile(service) > service.latency_slo_ms)
+            return (was_degraded, self.degraded.get(service.pk, False))
+        finally:
+            self.lock.release()
+
+    """
+    Returns the service's latency_slo_percentile of its window, using
+    the nearest-rank method.
+    """
+    def percentile(self, service):
+        window = sorted(self.windows.get(service.pk) or [])
+        if not window:
+            return None
+        rank = int(math.ceil(len(window) * service.latency_slo_percentile / 100.0))
+        return window[min(max(rank, 1), len(window)) - 1]
+
+# The tracker shared by everything running in this process
+latency_tracker = LatencyTracker()
@@ -0,0 +1,118 @@
+import datetime
+
+from .models import *
+from .writer import update_rollups
+from django.db import connection, transaction
+from django.db.models import Min
+from django.conf import settings
+
+# PingLog entries older than this many days are deleted
+SERVICE_MONITOR_PINGLOG_RETENTION_DAYS = getattr(settings, "SERVICE_MONITOR_PINGLOG_RETENTION_DAYS", 30)
+
+# Minute rollups older than this many days are deleted
+SERVICE_MONITOR_MINUTE_ROLLUP_RETENTION_DAYS = getattr(settings, "SERVICE_MONITOR_MINUTE_ROLLUP_RETENTION_DAYS", 7)
+
+# Hourly rollups older than this many days are deleted (daily rollups are kept)
+SERVICE_MONITOR_HOURLY_ROLLUP_RETENTION_DAYS = getattr(settings, "SERVICE_MONITOR_HOURLY_ROLLUP_RETENTION_DAYS", 365)
+
+# The number of PingLog entries (or rollups) deleted per transaction
+SERVICE_MONITOR_RETENTION_BATCH_SIZE = getattr(settings, "SERVICE_MONITOR_RETENTION_BATCH_SIZE", 10000)
+
+# The maximum number of batches processed by each scheduled run (None for no limit)
+SERVICE_MONITOR_RETENTION_MAX_BATCHES = getattr(settings, "SERVICE_MONITOR_RETENTION_MAX_BATCHES", 100)
+
+# The ping states of the entries whose total_ms is counted as a latency
+RESPONSE_STATES = (SERVICE_MONITOR__VALID_RESPONSE_RECEIVED, SERVICE_MONITOR__INVALID_RESPONSE_RECEIVED, SERVICE_MONITOR__DEGRADED)
+
+"""
+Returns the date from which PingLog entries have been counted in the
+rollups as they were written (see PingLogRollupStart). The first time
+it is asked for, it is taken from the earliest minute rollup, which
+only the writer creates, and recorded, since the minute rollups are
+pruned themselves. If there are none yet, nothing was counted before
+now.
+"""
+def get_rollup_start():
+    starts = list(PingLogRollupStart.objects.order_by("pk")[:1])
+    if starts:
+        return starts[0].date
+    date = PingLogRollup.objects.filter(granularity=SERVICE_MONITOR__MINUTE).aggregate(Min("first_date"))["first_date__min"]
+    start = PingLogRollupStart.objects.create(date=date or datetime.datetime.now())
+    return start.date
+
+"""
+Deletes one batch of the oldest rows of the given model whose
+date_field is before the given date and whose fields have the given
+values, if any. PingLog entries are counted in the PingLogRollups
+when they are written (see writer.py), so nothing is lost but the raw
+entry; if rollup_start is given, the entries of the batch older than
+it, which were written before that, are counted first. Returns the
+number of rows deleted.
+"""
+@transaction.commit_on_success
+def delete_batch(model, date_field, before, batch_size, filters=None, rollup_start=None):
+    filters = filters or {}
+    objects = model.objects.filter(**{"%s__lt" % date_field: before}).filter(**filters)
+    pks = list(objects.order_by("pk").values_list("pk", flat=True)[:batch_size])
+    if not pks:
+        return 0
+
+    if rollup_start is not None:
+        uncounted = objects.filter(pk__lte=pks[-1], **{"%s__lt" % date_field: rollup_start})
+        entries = []
+        for entry in uncounted:
+            if entry.ping_state in RESPONSE_STATES:
+                entries.append((entry, entry.total_ms))
+            else:
+                entries.append((entry, None))
+        if entries:
+            update_rollups(entries)
+
+    # Delete the batch without loading it into memory
+    qn = connection.ops.quote_name
+    conditions = ["%s <= %%s" % qn(model._meta.pk.column), "%s < %%s" % qn(model._meta.get_field(date_field).column)]
+    params = [pks[-1], before]
+    for field_name, value in filters.items():
+        conditions.append("%s = %%s" % qn(model._meta.get_field(field_name).column))
+        params.append(value)
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE %s" % (qn(model._meta.db_table), " AND ".join(conditions)), params)
+    transaction.set_dirty()
+    return len(pks)
+
+"""
+Deletes the rows delete_batch() selects in batches of batch_size,
+stopping after max_batches batches if given. Returns the number of
+rows deleted.
+"""
+def delete_in_batches(model, date_field, before, batch_size, max_batches=None, filters=None, rollup_start=None):
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        count = delete_batch(model, date_field, before, batch_size, filters, rollup_start)
+        total += count
+        batches += 1
+        if count < batch_size:
+            break
+    return total
+
+"""
+Deletes PingLog entries older than the given number of days in
+batches of batch_size, stopping after max_batches batches if given,
+counting those written before the rollups were kept up to date in the
+rollups first, and deletes minute and hourly rollups past their retention periods
+in the same way. Returns the number of PingLog entries deleted.
+"""
+def prune_pinglog(days=None, batch_size=None, max_batches=None):
+    days = days or SERVICE_MONITOR_PINGLOG_RETENTION_DAYS
+    batch_size = batch_size or SERVICE_MONITOR_RETENTION_BATCH_SIZE
+    now = datetime.datetime.now()
+    before = now - datetime.timedelta(days=days)
+
+    total = delete_in_batches(PingLog, "date", before, batch_size, max_batches, rollup_start=get_rollup_start())
+
+    minute_before = now - datetime.timedelta(days=SERVICE_MONITOR_MINUTE_ROLLUP_RETENTION_DAYS)
+    delete_in_batches(PingLogRollup, "period_start", minute_before, batch_size, max_batches, {"granularity": SERVICE_MONITOR__MINUTE})
+    hourly_before = now - datetime.timedelta(days=SERVICE_MONITOR_HOURLY_ROLLUP_RETENTION_DAYS)
+    delete_in_batches(PingLogRollup, "period_start", hourly_before, batch_size, max_batches, {"granularity": SERVICE_MONITOR__HOURLY})
+    return total
@@ -0,0 +1,197 @@
+import datetime
+import heapq
+import threading
+
+from .models import *
+from .dispatch import SERVICE_MONITOR_PROBE_DISPATCH
+from .config import service_config_changed
+from django.db.models.signals import post_save, post_delete
+from django.conf import settings
+
+# How often the schedule is rebuilt from the database regardless of
+# signals, to pick up edits made in other processes (i.e. the admin)
+SERVICE_MONITOR_SCHEDULE_RELOAD_MINUTES = getattr(settings, "SERVICE_MONITOR_SCHEDULE_RELOAD_MINUTES", 5)
+
+"""
+Returns the local naive date at which a service with the given
+next_ping_at and timeout_at next needs attention, whichever of the
+two comes first.
+"""
+def due_date(next_ping_at, timeout_at):
+    dates = [local_datetime(date) for date in (next_ping_at, timeout_at) if date is not None]
+    if dates:
+        return min(dates)
+    else:
+        return datetime.datetime.min
+
+"""
+An in-memory priority queue of the active services which are due
+before the next reload, keyed on the date at which each one is due.
+This lets the periodic task pop only the services that actually need
+attention instead of loading and checking every active service on
+each run.
+
+The queue is filled from an indexed range query on next_ping_at and
+timeout_at, and rebuilt every SERVICE_MONITOR_SCHEDULE_RELOAD_MINUTES
+to pick up changes made in other processes, such as edits in the
+admin. Services saved or deleted in this process are rescheduled
+immediately through signals. If service_types is given, only services
+of those types are scheduled.
+"""
+class ProbeSchedule(object):
+    def __init__(self, service_types=None):
+        self.service_types = service_types
+        self.lock = threading.RLock()
+        self.changed = threading.Event()
+        self.heap = []
+        self.due_dates = {}
+        self.loaded_date = None
+        self.horizon = None
+
+    """
+    Marks the schedule as stale so that it is rebuilt on next use, and
+    wakes up anything waiting on it.
+    """
+    def invalidate(self):
+        self.lock.acquire()
+        try:
+            self.loaded_date = None
+        finally:
+            self.lock.release()
+        self.changed.set()
+
+    def needs_reload(self, now):
+        if self.loaded_date is None:
+            return True
+        return now - self.loaded_date > datetime.timedelta(minutes=SERVICE_MONITOR_SCHEDULE_RELOAD_MINUTES)
+
+    """
+    Rebuilds the queue from all active services in the database which
+    are due before the next reload.
+    """
+    def reload(self, now=None):
+        now = now or datetime.datetime.now()
+        self.lock.acquire()
+        try:
+            self.heap = []
+            self.due_dates = {}
+            self.horizon = now + datetime.timedelta(minutes=SERVICE_MONITOR_SCHEDULE_RELOAD_MINUTES)
+            services = Service.objects.due(self.horizon)
+            if self.service_types is not None:
+                services = services.filter(service_type__in=self.service_types)
+            for service_id, next_ping_at, timeout_at in services.values_list("pk", "next_ping_at", "timeout_at"):
+                self.due_dates[service_id] = due_date(next_ping_at, timeout_at)
+                self.heap.append((self.due_dates[service_id], service_id))
+            heapq.heapify(self.heap)
+            self.loaded_date = now
+        finally:
+            self.lock.release()
+
+    """
+    (Re)schedules the given service based on its current state. Services
+    which are not due before the next reload are left for it to pick up.
+    """
+    def push(self, service):
+        self.lock.acquire()
+        try:
+            date = due_date(service.next_ping_at, service.timeout_at)
+            if service.active and self.horizon is not None and date <= self.horizon and (self.service_types is None or service.service_type in self.service_types):
+                self.due_dates[service.pk] = date
+                heapq.heappush(self.heap, (date, service.pk))
+            else:
+                self.due_dates.pop(service.pk, None)
+        finally:
+            self.lock.release()
+        self.changed.set()
+
+    """
+    Removes and returns the ids of all services which are due at the
+    given local naive date.
+    """
+    def pop_due(self, now=None):
+        now = now or datetime.datetime.now()
+        self.lock.acquire()
+        try:
+            if self.needs_reload(now):
+                self.reload(now)
+            service_ids = []
+            while self.heap and self.heap[0][0] <= now:
+                date, service_id = heapq.heappop(self.heap)
+                # Entries superseded by a later push are skipped
+                if self.due_dates.get(service_id) == date:
+                    del self.due_dates[service_id]
+                    service_ids.append(service_id)
+            return service_ids
+        finally:
+            self.lock.release()
+
+    """
+    Returns the number of seconds until the next service is due (0 if
+    one is already due), or None if no services are scheduled.
+    """
+    def seconds_until_due(self, now=None):
+        now = now or datetime.datetime.now()
+        self.lock.acquire()
+        try:
+            if self.needs_reload(now):
+                self.reload(now)
+            while self.heap and self.due_dates.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return None
+            delta = self.heap[0][0] - now
+            return max(0, delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0)
+        finally:
+            self.lock.release()
+
+    """
+    Blocks until the next service is due, the schedule changes, or
+    max_wait seconds have passed, whichever comes first.
+    """
+    def wait(self, max_wait):
+        seconds = self.seconds_until_due()
+        if seconds is None or seconds > max_wait:
+            seconds = max_wait
+        if seconds > 0:
+            self.changed.clear()
+            self.changed.wait(seconds)
+
+    """
+    Removes the given service from the queue.
+    """
+    def discard(self, service):
+        self.lock.acquire()
+        try:
+            self.due_dates.pop(service.pk, None)
+        finally:
+            self.lock.release()
+
+# The schedule shared by everything running in this process. When HTTP
+# services are probed through celery or the probe daemon, it only holds
+# SMS services.
+if SERVICE_MONITOR_PROBE_DISPATCH in ("celery", "daemon"):
+    schedule = ProbeSchedule(service_types=[SERVICE_MONITOR__SMS])
+else:
+    schedule = ProbeSchedule()
+
+"""
+Keeps the schedule in step with every save and delete of a Service
+made in this process, including those made by the periodic task and
+the SMS handler themselves.
+"""
+def reschedule_service(sender, instance, **kwargs):
+    schedule.push(instance)
+
+def unschedule_service(sender, instance, **kwargs):
+    schedule.discard(instance)
+
+"""
+Rebuilds the schedule when services were edited in another process
+(see config.py), rather than on its next reload.
+"""
+def invalidate_schedule(sender, **kwargs):
+    schedule.invalidate()
+
+post_save.connect(reschedule_service, sender=Service, dispatch_uid="monitor.schedule.reschedule_service")
+post_delete.connect(unschedule_service, sender=Service, dispatch_uid="monitor.schedule.unschedule_service")
+service_config_changed.connect(invalidate_schedule, dispatch_uid="monitor.schedule.invalidate_schedule")
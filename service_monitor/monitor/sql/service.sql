@@ -0,0 +1,2 @@
+CREATE INDEX service_monitor_service_active_next_ping_at ON service_monitor_service (active, next_ping_at);
+CREATE INDEX service_monitor_service_active_timeout_at ON service_monitor_service (active, timeout_at);
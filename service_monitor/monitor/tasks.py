@@ -1,124 +1,509 @@
 import datetime
+import logging
 import pytz
+import threading
 import urllib2
 
 from .models import *
+from .probe import probe_engine, CircuitOpenError, latency_tracker
+from .schedule import schedule
+from .writer import writer, PingLogWriter
+from .retention import prune_pinglog, SERVICE_MONITOR_RETENTION_MAX_BATCHES
+from .dispatch import split_into_shards, shard_queue, SERVICE_MONITOR_PROBE_DISPATCH
+from .notify import notifications
+from .alerts import alert_tracker, REALERT, RECOVERED
+from .outbox import outbox
+from .config import service_config
+from celery.task import task, periodic_task
+from django.db import connection
 from django.db.models import Q
-from rapidsms.contrib.messaging.utils import send_message
-from django.core.mail import EmailMessage
 from django.conf import settings
-from urllib2 import URLError
+
+# What to do at startup with SMS services which missed pings while the
+# monitor was down: "skip" the missed pings and wait for the next one
+# due, "coalesce" them into a single ping sent right away, or "backfill"
+# up to SERVICE_MONITOR_SMS_BACKFILL_PINGS of them, one per run
+SERVICE_MONITOR_SMS_CATCH_UP = getattr(settings, "SERVICE_MONITOR_SMS_CATCH_UP", "coalesce")
+
+# The maximum number of missed pings sent by the "backfill" policy
+SERVICE_MONITOR_SMS_BACKFILL_PINGS = getattr(settings, "SERVICE_MONITOR_SMS_BACKFILL_PINGS", 3)
+
+# Whether services are pinged by a dedicated loop which wakes up whenever
+# the next service is due, instead of by the EventSchedule every minute
+SERVICE_MONITOR_PROBE_LOOP = getattr(settings, "SERVICE_MONITOR_PROBE_LOOP", False)
+
+# The maximum number of seconds the probe loop sleeps between runs
+SERVICE_MONITOR_PROBE_LOOP_MAX_WAIT_SECONDS = getattr(settings, "SERVICE_MONITOR_PROBE_LOOP_MAX_WAIT_SECONDS", 60)
+
+logger = logging.getLogger("monitor.tasks")
 
 """
 Sends a "Service Not Responding" email to the list of email 
-recipients specified for the given service.
+recipients specified for the given service. The email is queued
+and sent in the background, possibly merged with others to the
+same recipient into a digest.
+
+For a service whose responses have become slower than its
+latency limit (ping_state SERVICE_MONITOR__DEGRADED), or have
+come back within it (latency_recovered=True), a "Service Slow"
+or "Service Latency Recovered" email is sent instead, quoting
+the current latency percentile given as latency_ms.
+
+A "Service Recovered" email is sent for a service which is
+responding again after an alert (recovered=True), and an alert
+repeated while the service keeps failing (repeated=True) says so.
 """
 def send_notification_email(service, **kwargs):
     subject_text = "Service Monitor: Service '" + service.name + "'"
     body_text = ""
     
     if service.service_type == SERVICE_MONITOR__SMS:
+        # The connection comes from the configuration cache rather than a query per email
+        identity = service_config.connection(service).identity
+        target_text = "mobile number: " + identity
+    else:
+        target_text = "url: " + service.url
+    
+    if kwargs.get("recovered"):
+        body_text = "Responding again for " + target_text
+    elif kwargs.get("latency_recovered"):
+        body_text = "Latency back within " + str(service.latency_slo_ms) + " ms (p" + str(service.latency_slo_percentile) + " is " + str(kwargs["latency_ms"]) + " ms) for " + target_text
+    elif service.ping_state == SERVICE_MONITOR__DEGRADED:
+        body_text = "Latency above " + str(service.latency_slo_ms) + " ms (p" + str(service.latency_slo_percentile) + " is " + str(kwargs["latency_ms"]) + " ms) for " + target_text
+    elif service.service_type == SERVICE_MONITOR__SMS:
         if service.ping_state == SERVICE_MONITOR__NO_RESPONSE:
-            body_text = "No response for mobile number: " + service.connection.identity
+            body_text = "No response for mobile number: " + identity
         elif service.ping_state == SERVICE_MONITOR__INVALID_RESPONSE_RECEIVED:
-            body_text = "Invalid response for mobile number: " + service.connection.identity
+            body_text = "Invalid response for mobile number: " + identity
     elif service.service_type == SERVICE_MONITOR__HTTP:
         urlerror = kwargs["urlerror"]
-        if isinstance(urlerror, urllib2.HTTPError):
+        if service.ping_state == SERVICE_MONITOR__INVALID_RESPONSE_RECEIVED:
+            body_text = "Invalid response (" + str(urlerror.reason) + ") for url: " + service.url
+        elif isinstance(urlerror, CircuitOpenError):
+            body_text = "Host unreachable (" + str(urlerror.reason) + ") for url: " + service.url
+        elif isinstance(urlerror, urllib2.HTTPError):
             body_text = "HTTP Error Code '" + str(urlerror.code) + "' for url: " + service.url
         else:
             body_text = "URL Error '" + str(type(urlerror)) + "' for url: " + service.url
     
-    recipients = service.email_list.split("|")
+    if kwargs.get("repeated"):
+        body_text = "Still failing: " + body_text
     
-    email = EmailMessage (
-        subject = subject_text
-       ,body = body_text
-       ,to = recipients
-    )
-    email.send()
+    # Queue the email rather than wait on the mail server (see notify.py)
+    notifications.send(subject_text, body_text, service.email_list.split("|"))
+
+"""
+Records the given HTTP ProbeResults: marks each service as having
+responded (possibly degraded or with an invalid body) or not, logs
+them through the given PingLogWriter, and sends the notification
+emails the alert tracker asks for (see alerts.py). The caller is
+responsible for flushing the writer.
+"""
+def record_http_results(results, result_writer):
+    for result in results:
+        service = result.service
+        if result.succeeded():
+            # Mark the service as having responded, and as degraded if its responses are too slow
+            was_degraded, is_degraded = latency_tracker.observe(service, result.latency_ms())
+            service.last_response_date = result.finished
+            if is_degraded:
+                service.ping_state = SERVICE_MONITOR__DEGRADED
+            else:
+                service.ping_state = SERVICE_MONITOR__VALID_RESPONSE_RECEIVED
+            result_writer.save(service, "last_response_date", "ping_state")
+            
+            # Create an entry in the PingLog
+            result_writer.log(service, result.finished, latency_ms=result.latency_ms(), **result.timings())
+            
+            # Send an email notification when the service recovers from an alert, or becomes degraded or recovers from that
+            if alert_tracker.observe(service, False) == RECOVERED:
+                send_notification_email(service,recovered=True)
+            if is_degraded != was_degraded:
+                send_notification_email(service,latency_ms=latency_tracker.percentile(service),latency_recovered=was_degraded)
+        elif result.invalid():
+            # Mark the service as having responded with a body not matching valid_body_regex
+            service.last_response_date = result.finished
+            service.ping_state = SERVICE_MONITOR__INVALID_RESPONSE_RECEIVED
+            result_writer.save(service, "last_response_date", "ping_state")
+            
+            # Create an entry in the PingLog
+            result_writer.log(service, result.finished, latency_ms=result.latency_ms(), **result.timings())
+            
+            # Send an email notification, unless the alert tracker holds it back
+            action = alert_tracker.observe(service, True)
+            if action:
+                send_notification_email(service,urlerror=result.error,repeated=(action == REALERT))
+        else:
+            # Mark the request as having no response
+            service.ping_state = SERVICE_MONITOR__NO_RESPONSE
+            result_writer.save(service, "ping_state")
+            
+            # Create an entry in the PingLog
+            result_writer.log(service, result.finished, **result.timings())
+            
+            # Send an email notification, unless the alert tracker holds it back
+            action = alert_tracker.observe(service, True)
+            if action:
+                send_notification_email(service,urlerror=result.error,repeated=(action == REALERT))
+
+"""
+Marks the SMS request of the given service, which has timed out, as
+having no response, logs it and sends the notification email the
+alert tracker asks for. The caller is responsible for flushing the
+writer.
+"""
+def record_timeout(service):
+    # Mark the request as having no response
+    alert_tracker.seed(service)
+    service.ping_state = SERVICE_MONITOR__NO_RESPONSE
+    writer.save(service, "ping_state")
+    
+    # Create an entry in the PingLog
+    current_date = datetime.datetime.now(tz=pytz.utc)
+    writer.log(service, current_date)
+    
+    # Send an email notification, unless the alert tracker holds it back
+    action = alert_tracker.observe(service, True)
+    if action:
+        send_notification_email(service,repeated=(action == REALERT))
 
 """
 This is the callback function that is called by the
-EventSchedule every minute. For each service in the 
-database that is active, this function will see if enough 
-time has passed to ping the service again, and ping the 
-service accordingly.
+EventSchedule every minute. It pings the due services (see
+run_due), unless SERVICE_MONITOR_PROBE_LOOP is set, in which
+case the probe loop does that instead.
 """
 def run(*args, **kwargs):
-    for service in Service.objects.filter(active=True):
+    if SERVICE_MONITOR_PROBE_LOOP:
+        return
+    run_due()
+
+"""
+For each active service which the schedule says is due, this
+function will see if enough time has passed to ping the 
+service again, and ping the service accordingly. HTTP services
+that are due are all pinged concurrently once the scan is
+complete, and SMS requests are queued in the outbox, which
+spreads them out.
+
+All state changes and PingLog entries are buffered in the 
+writer and flushed in bulk: once before any SMS is queued or
+HTTP request is made, and once after the HTTP results are in.
+
+The due services are leased for the duration of the run, so
+that other monitor nodes sharing the database leave them
+alone. Services leased by another node are dropped from the
+schedule until its next reload.
+
+If wait is false, the due HTTP services are probed in the
+background (see run_leased) instead of before this returns.
+"""
+def run_due(wait=True):
+    # Flush anything buffered by the SMS handler so the services below are loaded with their latest state
+    writer.flush()
+    
+    # Pick up services edited in other processes (see config.py)
+    service_config.check()
+    
+    # Services still being probed in the background are due again once their interval passes, but are left alone
+    # until their results are written, which puts them back on the schedule (see probe_in_background)
+    service_ids = [service_id for service_id in schedule.pop_due() if service_id not in probes_in_flight]
+    if not service_ids:
+        return
+    
+    services = list(Service.objects.lease(service_ids))
+    probing_ids = []
+    try:
+        probing_ids = run_leased(services, wait)
+    finally:
+        # The leases of queued SMS requests are released by the outbox once they are handed off, and those of
+        # services probed in the background once their results are written
+        Service.objects.release([service.pk for service in services if service.pk not in outbox and service.pk not in probing_ids])
+
+"""
+Pings the given services, which have been leased by run_due().
+
+If wait is false, the due HTTP services are probed and their
+results written by a background thread, which releases their leases
+once it is done, and their ids are returned; otherwise they are
+probed before this returns, and an empty list is returned.
+"""
+def run_leased(services, wait=True):
+    sms_services = []
+    http_services = []
+    for service in services:
+        if service.pk in probes_in_flight:
+            # Still being probed in the background, and put back on the schedule once its results are written
+            continue
+        
+        # Services that turn out not to need anything yet are put back on the schedule
+        schedule.push(service)
+        
         if service.service_type == SERVICE_MONITOR__SMS:
             #
             # Handle SMS Monitoring
             #
-            if service.can_ping_again():
-                # Mark the request as being sent for this service
+            if service.pk in outbox:
+                # The last request is still waiting in the outbox, so the ping due now is folded into it
+                if service.can_ping_again():
+                    service.last_request_date = service.next_ping_date()
+                    writer.save(service, "last_request_date")
+                    outbox.fold(service)
+            elif service.can_ping_again():
+                # Start tracking latency and alerts from the state the service was last left in
+                latency_tracker.seed(service)
+                alert_tracker.seed(service)
+                
+                # Mark the request as queued for the ping slot it is sent for; it is marked as sent, and starts
+                # to time out, once it is handed to the backend (see outbox.py)
                 current_date = datetime.datetime.now(tz=pytz.utc)
                 if service.last_request_date:
-                    service.last_request_date += datetime.timedelta(minutes=service.ping_interval_minutes)
+                    service.last_request_date = service.next_ping_date()
                 else:
                     service.last_request_date = current_date
                 service.last_response_date = None
-                service.ping_state = SERVICE_MONITOR__REQUEST_SENT
-                service.save()
+                service.ping_state = SERVICE_MONITOR__REQUEST_QUEUED
+                service.request_token = generate_token()
+                writer.save(service, "last_request_date", "last_response_date", "ping_state", "request_token")
                 
-                # Create an entry in the PingLog
-                pinglog_entry = PingLog(service=service,date=current_date,ping_state=service.ping_state)
-                pinglog_entry.save()
-                
-                # Send the SMS
-                send_message(service.connection, service.sms_to_send)
+                # The SMS itself is queued below, once the request state has been written
+                sms_services.append(service)
             elif service.ping_state == SERVICE_MONITOR__REQUEST_SENT and service.has_timed_out():
-                # Mark the request as having no response
-                service.ping_state = SERVICE_MONITOR__NO_RESPONSE
-                service.save()
-                
-                # Create an entry in the PingLog
-                current_date = datetime.datetime.now(tz=pytz.utc)
-                pinglog_entry = PingLog(service=service,date=current_date,ping_state=service.ping_state)
-                pinglog_entry.save()
-                
-                # Send an email notification
-                send_notification_email(service)
+                record_timeout(service)
         elif service.service_type == SERVICE_MONITOR__HTTP:
             #
             # Handle HTTP Monitoring
             #
             if service.can_ping_again():
+                # Start tracking latency and alerts from the state the service was last left in
+                latency_tracker.seed(service)
+                alert_tracker.seed(service)
+                
                 # Mark the request as being sent for this service
                 current_date = datetime.datetime.now(tz=pytz.utc)
                 service.last_request_date = current_date
                 service.last_response_date = None
                 service.ping_state = SERVICE_MONITOR__REQUEST_SENT
-                service.save()
+                writer.save(service, "last_request_date", "last_response_date", "ping_state")
                 
-                # Create an entry in the PingLog
-                pinglog_entry = PingLog(service=service,date=current_date,ping_state=service.ping_state)
-                pinglog_entry.save()
+                # Create an entry in the PingLog; while the service is alerted on, it is only counted in the rollups
+                writer.log(service, current_date, rollup_only=alert_tracker.is_alerting(service))
                 
-                # Try to send the request
-                try:
-                    result = urllib2.urlopen(service.url,timeout=service.timeout_minutes*60)
-                    
-                    # Mark the service as having responded 
-                    current_date = datetime.datetime.now(tz=pytz.utc)
-                    service.last_response_date = current_date
-                    service.ping_state = SERVICE_MONITOR__VALID_RESPONSE_RECEIVED
-                    service.save()
-                    
-                    # Create an entry in the PingLog
-                    pinglog_entry = PingLog(service=service,date=current_date,ping_state=service.ping_state)
-                    pinglog_entry.save()
-                except URLError as e:
-                    # Mark the request as having no response
-                    service.ping_state = SERVICE_MONITOR__NO_RESPONSE
-                    service.save()
-                    
-                    # Create an entry in the PingLog
-                    current_date = datetime.datetime.now(tz=pytz.utc)
-                    pinglog_entry = PingLog(service=service,date=current_date,ping_state=service.ping_state)
-                    pinglog_entry.save()
-                    
-                    # Send an email notification
-                    send_notification_email(service,urlerror=e)
+                # The request itself is sent below, concurrently with all other due HTTP services
+                http_services.append(service)
+    
+    writer.flush()
+    
+    # Queue the SMS to be sent at a limited rate (see outbox.py), which marks each one as sent and logs it as it is
+    # handed to its backend; while the service is alerted on, the entry is only counted in the rollups
+    for service in sms_services:
+        outbox.send(service, rollup_only=alert_tracker.is_alerting(service))
+    
+    #
+    # Send all due HTTP requests concurrently and record the results
+    #
+    if not wait:
+        if not http_services:
+            return []
+        probes_in_flight.update([service.pk for service in http_services])
+        thread = threading.Thread(target=probe_in_background, args=(http_services,), name="monitor.probes")
+        thread.setDaemon(True)
+        thread.start()
+        return [service.pk for service in http_services]
+    
+    record_http_results(probe_engine.probe(http_services), writer)
+    
+    writer.flush()
+    return []
+
+# The ids of the HTTP services being probed in the background in this process
+probes_in_flight = set()
+
+"""
+Probes the given HTTP services, which have been leased and marked
+as sent by run_leased(), records their results and releases their
+leases. Run in a thread of its own for each run of the probe loop,
+so the loop keeps ticking (and sending SMS requests and timing them
+out) while the probes are in flight. All runs share probe_engine, so
+its caps hold across the probes of overlapping runs.
+"""
+def probe_in_background(services):
+    try:
+        record_http_results(probe_engine.probe(services), writer)
+        writer.flush()
+    except Exception:
+        logger.exception("Could not record the probe results")
+    finally:
+        service_ids = [service.pk for service in services]
+        try:
+            Service.objects.release(service_ids)
+        finally:
+            probes_in_flight.difference_update(service_ids)
+            connection.close()
+            # The flush has rescheduled them already, unless run_due dropped them while they were still in flight
+            for service in services:
+                schedule.push(service)
+
+"""
+The dedicated probe loop used when SERVICE_MONITOR_PROBE_LOOP is
+set. Rather than waking up on every minute tick, it sleeps on the
+schedule until the next service is due (or a service is saved),
+so services can be pinged every few seconds (see
+Service.ping_interval_seconds) while an idle monitor does no work
+at all between pings. The HTTP services of each run are probed in
+the background, so a slow probe never holds up the next run.
+"""
+def probe_forever():
+    while True:
+        try:
+            run_due(wait=False)
+        except Exception:
+            logger.exception("Probe loop run failed")
+        schedule.wait(SERVICE_MONITOR_PROBE_LOOP_MAX_WAIT_SECONDS)
+
+"""
+Starts the probe loop in a background thread of this process, if
+it is not running yet.
+"""
+def start_probe_loop():
+    global probe_loop_thread
+    if probe_loop_thread is None or not probe_loop_thread.isAlive():
+        probe_loop_thread = threading.Thread(target=probe_forever, name="monitor.probe_loop")
+        probe_loop_thread.setDaemon(True)
+        probe_loop_thread.start()
+
+# The thread running the probe loop in this process, if any
+probe_loop_thread = None
+
+"""
+Applies the SERVICE_MONITOR_SMS_CATCH_UP policy to the SMS services
+which have missed more than one ping, e.g. because the router was
+down. Without it, run() would send one catch-up ping per minute for
+every missed interval until the service is back on schedule. Instead,
+the last request date of each of them is moved to the number of
+intervals before the latest missed ping which leaves the number of
+pings the policy allows, all in one batch, so catching up costs one
+update per service however long the monitor was down. Called by
+the app when the router starts.
+
+Moving the last request date would also move the timeout of a
+request still awaiting its response, so those services are left
+alone until the timeout fires (a request awaiting its response
+cannot be more than one ping behind, unless its timeout is longer
+than its interval), and requests which timed out while the monitor
+was down are marked as such first.
+"""
+def catch_up(policy=None):
+    policy = policy or SERVICE_MONITOR_SMS_CATCH_UP
+    if policy == "skip":
+        pings = 0
+    elif policy == "coalesce":
+        pings = 1
+    elif policy == "backfill":
+        pings = SERVICE_MONITOR_SMS_BACKFILL_PINGS
+    else:
+        raise ValueError("Unknown SMS catch-up policy: %s" % policy)
+    
+    now = datetime.datetime.now()
+    service_ids = Service.objects.due(now).filter(service_type=SERVICE_MONITOR__SMS, last_request_date__isnull=False).values_list("pk", flat=True)
+    services = list(Service.objects.lease(list(service_ids)))
+    try:
+        for service in services:
+            if service.ping_state == SERVICE_MONITOR__REQUEST_SENT:
+                if not service.has_timed_out():
+                    continue
+                record_timeout(service)
+            interval = datetime.timedelta(seconds=service.get_ping_interval_seconds())
+            latest = service.ping_slot_after(now) - interval
+            last_request_date = latest - interval * pings
+            if last_request_date > local_datetime(service.last_request_date):
+                service.last_request_date = last_request_date
+                writer.save(service, "last_request_date")
+        writer.flush()
+    finally:
+        Service.objects.release([service.pk for service in services])
+
+"""
+Queues the SMS requests which were still waiting in the outbox of
+a monitor process when it stopped, so that they are not lost until
+the next ping of their services. Requests whose services are due
+again are left for the next run to replace with a new request, and
+requests queued by another node are left alone, since it holds the
+leases of their services until they are handed off. Called by the
+app when the router starts.
+"""
+def requeue():
+    service_ids = Service.objects.filter(active=True, service_type=SERVICE_MONITOR__SMS, ping_state=SERVICE_MONITOR__REQUEST_QUEUED).values_list("pk", flat=True)
+    idle_ids = []
+    for service in Service.objects.lease(list(service_ids)):
+        if service.ping_state == SERVICE_MONITOR__REQUEST_QUEUED and service.pk not in outbox and not service.can_ping_again():
+            latency_tracker.seed(service)
+            alert_tracker.seed(service)
+            outbox.send(service, rollup_only=alert_tracker.is_alerting(service))
+        else:
+            idle_ids.append(service.pk)
+    if idle_ids:
+        Service.objects.release(idle_ids)
+
+"""
+This is the callback function that is called by the
+EventSchedule once a day to delete old PingLog entries
+and rollups (see retention.py). Each run processes at most
+SERVICE_MONITOR_RETENTION_MAX_BATCHES batches; any backlog
+is picked up by the following runs, or can be cleared with
+the prune_pinglog management command.
+"""
+def prune(*args, **kwargs):
+    prune_pinglog(max_batches=SERVICE_MONITOR_RETENTION_MAX_BATCHES)
+
+"""
+This is the celery periodic task run by celerybeat every
+minute when SERVICE_MONITOR_PROBE_DISPATCH is "celery". It
+splits the HTTP services which are due into shards by host
+(see dispatch.py) and routes each shard to its own queue, so
+each host is always probed by the same celeryd process.
+"""
+@periodic_task(run_every=datetime.timedelta(minutes=1), ignore_result=True)
+def dispatch_probes():
+    if SERVICE_MONITOR_PROBE_DISPATCH != "celery":
+        return
+    services = Service.objects.due().filter(service_type=SERVICE_MONITOR__HTTP).only("id", "url")
+    for shard, service_ids in split_into_shards(services).items():
+        # Shards nobody picked up by the next run are dispatched again by it, so they are dropped
+        probe_shard.apply_async(args=[service_ids], queue=shard_queue(shard), expires=60)
 
+"""
+This is the celery task which probes one shard of HTTP 
+services. The services are leased before they are probed
+and checked against their freshly loaded state, so that a
+service dispatched twice (e.g. by overlapping runs, or by
+several celerybeat nodes) is only probed once per interval.
+"""
+@task(ignore_result=True)
+def probe_shard(service_ids):
+    services = list(Service.objects.lease(service_ids).filter(service_type=SERVICE_MONITOR__HTTP))
+    try:
+        shard_writer = PingLogWriter()
+        http_services = []
+        for service in services:
+            if service.can_ping_again():
+                # Start tracking latency and alerts from the state the service was last left in
+                latency_tracker.seed(service)
+                alert_tracker.seed(service)
+                
+                # Mark the request as being sent for this service
+                current_date = datetime.datetime.now(tz=pytz.utc)
+                service.last_request_date = current_date
+                service.last_response_date = None
+                service.ping_state = SERVICE_MONITOR__REQUEST_SENT
+                shard_writer.save(service, "last_request_date", "last_response_date", "ping_state")
+                
+                # Create an entry in the PingLog; while the service is alerted on, it is only counted in the rollups
+                shard_writer.log(service, current_date, rollup_only=alert_tracker.is_alerting(service))
+                http_services.append(service)
+        shard_writer.flush()
+        
+        record_http_results(probe_engine.probe(http_services), shard_writer)
+        shard_writer.flush()
+    finally:
+        Service.objects.release([service.pk for service in services])
@@ -0,0 +1,901 @@
+import BaseHTTPServer
+import datetime
+import pytz
+import smtplib
+import socket
+import SocketServer
+import threading
+import time
+import urllib2
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
+from django.test import TestCase
+from .models import *
+from .schedule import ProbeSchedule
+from .dispatch import split_into_shards, shard_queue
+from . import writer as writer_module
+from .writer import PingLogWriter
+from .retention import prune_pinglog
+from . import asyncprobe
+from .asyncprobe import AsyncProbeEngine, ResolverCache
+from .daemon import ProbeDaemon
+from .probe import CircuitOpenError, CircuitBreaker, ConnectionPool, Deadline, ProbeEngine, ProbeResult, LatencyTracker
+from .alerts import AlertTracker, ALERT, REALERT, RECOVERED
+from .outbox import TokenBucket, SmsOutbox
+from . import tasks
+from rapidsms.models import Backend, Connection
+from .lookup import ServiceIndex
+from .config import ServiceConfigCache, SNAPSHOT_KEY, CHUNK_KEY
+from . import notify
+from .notify import NotificationQueue
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+
+def create_service(**kwargs):
+    values = {
+        "name": "Test"
+       ,"service_type": SERVICE_MONITOR__HTTP
+       ,"url": "http://example.com/"
+       ,"email_list": "admin@example.com"
+       ,"ping_interval_minutes": 5
+       ,"timeout_minutes": 1
+    }
+    values.update(kwargs)
+    service = Service(**values)
+    service.save()
+    return service
+
+class ServiceTest(TestCase):
+    def test_interval_must_be_positive(self):
+        self.assertRaises(ValidationError, Service(ping_interval_minutes=0).clean)
+        self.assertRaises(ValidationError, Service(ping_interval_minutes=5, ping_interval_seconds=0).clean)
+        Service(ping_interval_minutes=0, ping_interval_seconds=10).clean()
+
+    def test_no_interval(self):
+        service = create_service(ping_interval_minutes=0)
+        self.assertEqual(service.phase_seconds(), 0)
+        now = datetime.datetime.now().replace(microsecond=0)
+        self.assertEqual(service.ping_slot_after(now), now + datetime.timedelta(seconds=1))
+    
+    def test_phases_are_spread_over_the_interval(self):
+        phases = [Service(pk=pk, ping_interval_seconds=60).phase_seconds() for pk in range(1, 601)]
+        self.assertTrue(min(phases) >= 0 and max(phases) < 60)
+        # Each tenth of the interval gets roughly a tenth of the services
+        for start in range(0, 60, 6):
+            self.assertTrue(30 <= len([phase for phase in phases if start <= phase < start + 6]) <= 90)
+        # The phase of a service never changes, and services pinged every few minutes keep to whole minutes
+        self.assertEqual(Service(pk=7, ping_interval_seconds=60).phase_seconds(), phases[6])
+        self.assertTrue(set([Service(pk=pk, ping_interval_minutes=5).phase_seconds() for pk in range(1, 101)]) <= set([0, 60, 120, 180, 240]))
+    
+    def test_ping_slots_keep_the_phase(self):
+        service = Service(pk=3, ping_interval_seconds=30)
+        phase = service.phase_seconds()
+        date = datetime.datetime(2012, 5, 1, 12, 0, 0)
+        slot = service.ping_slot_after(date)
+        self.assertTrue(date < slot <= date + datetime.timedelta(seconds=30))
+        self.assertEqual((slot - SERVICE_MONITOR__PHASE_EPOCH).seconds % 30, phase)
+        # Once a service is in phase, its next ping is one interval after the last
+        self.assertEqual(service.ping_slot_after(slot), slot + datetime.timedelta(seconds=30))
+
+class ProbeScheduleTest(TestCase):
+    def test_pop_due(self):
+        now = datetime.datetime.now()
+        due = create_service()
+        later = create_service(last_request_date=now)
+        schedule = ProbeSchedule()
+        self.assertEqual(schedule.pop_due(now + datetime.timedelta(seconds=1)), [due.pk])
+        # Popped services are not returned again until they are rescheduled
+        self.assertEqual(schedule.pop_due(now + datetime.timedelta(seconds=1)), [])
+        self.assertEqual(schedule.pop_due(later.next_ping_at), [later.pk])
+
+    def test_push_reschedules(self):
+        now = datetime.datetime.now()
+        service = create_service()
+        schedule = ProbeSchedule()
+        schedule.reload(now)
+        service.last_request_date = now
+        service.update_schedule()
+        schedule.push(service)
+        # Only the latest push counts
+        self.assertEqual(schedule.pop_due(now + datetime.timedelta(seconds=1)), [])
+        self.assertEqual(schedule.pop_due(service.next_ping_at), [service.pk])
+
+    def test_push_inactive(self):
+        now = datetime.datetime.now()
+        service = create_service()
+        schedule = ProbeSchedule()
+        schedule.reload(now)
+        service.active = False
+        schedule.push(service)
+        self.assertEqual(schedule.pop_due(now + datetime.timedelta(seconds=1)), [])
+
+    def test_service_types(self):
+        now = datetime.datetime.now()
+        create_service()
+        schedule = ProbeSchedule(service_types=[SERVICE_MONITOR__SMS])
+        self.assertEqual(schedule.pop_due(now + datetime.timedelta(seconds=1)), [])
+
+class DispatchTest(TestCase):
+    def test_services_on_a_host_share_a_shard(self):
+        services = [Service(pk=i, url="http://host%s.example.com/%s" % (i % 10, i)) for i in range(100)]
+        split = split_into_shards(services, shards=4)
+        self.assertTrue(set(split.keys()) <= set(range(4)))
+        shards = {}
+        for shard, service_ids in split.items():
+            for service_id in service_ids:
+                self.assertEqual(shards.setdefault(service_id % 10, shard), shard)
+        self.assertEqual(shard_queue(2), "monitor.probe_shard.2")
+
+class LeaseTest(TestCase):
+    def test_lease_is_exclusive(self):
+        service = create_service()
+        self.assertEqual([s.pk for s in Service.objects.lease([service.pk], owner="a")], [service.pk])
+        self.assertEqual(list(Service.objects.lease([service.pk], owner="b")), [])
+        Service.objects.release([service.pk], owner="b")
+        self.assertEqual(Service.objects.get(pk=service.pk).lease_owner, "a")
+        Service.objects.release([service.pk], owner="a")
+        self.assertEqual([s.pk for s in Service.objects.lease([service.pk], owner="b")], [service.pk])
+
+    def test_expired_lease_is_taken_over(self):
+        service = create_service()
+        Service.objects.filter(pk=service.pk).update(lease_owner="a", lease_expires_at=datetime.datetime.now() - datetime.timedelta(seconds=1))
+        self.assertEqual([s.pk for s in Service.objects.lease([service.pk], owner="b")], [service.pk])
+
+    def test_inactive_services_are_not_leased(self):
+        service = create_service(active=False)
+        self.assertEqual(list(Service.objects.lease([service.pk], owner="a")), [])
+
+class PingLogWriterTest(TestCase):
+    def test_flush(self):
+        service = create_service()
+        now = datetime.datetime.now()
+        writer = PingLogWriter()
+        service.last_request_date = now
+        service.ping_state = SERVICE_MONITOR__REQUEST_SENT
+        writer.save(service, "last_request_date", "ping_state")
+        writer.log(service, now)
+        writer.log(service, now, rollup_only=True)
+        self.assertEqual(PingLog.objects.count(), 0)
+        writer.flush()
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(PingLog.objects.filter(service=service).count(), 1)
+        saved = Service.objects.get(pk=service.pk)
+        self.assertEqual(saved.ping_state, SERVICE_MONITOR__REQUEST_SENT)
+        self.assertEqual(saved.next_ping_at, service.next_ping_at)
+        # The rollup only entry is counted too
+        for granularity in (SERVICE_MONITOR__MINUTE, SERVICE_MONITOR__HOURLY, SERVICE_MONITOR__DAILY):
+            self.assertEqual(PingLogRollup.objects.get(service=service, granularity=granularity).request_sent_count, 2)
+
+    def test_rollups_are_merged(self):
+        service = create_service()
+        now = datetime.datetime.now().replace(second=30)
+        writer = PingLogWriter()
+        writer.log(service, now, ping_state=SERVICE_MONITOR__VALID_RESPONSE_RECEIVED, latency_ms=100)
+        writer.flush()
+        writer.log(service, now, ping_state=SERVICE_MONITOR__VALID_RESPONSE_RECEIVED, latency_ms=300)
+        writer.log(service, now + datetime.timedelta(minutes=1), ping_state=SERVICE_MONITOR__NO_RESPONSE)
+        writer.flush()
+        minute = PingLogRollup.objects.get(service=service, granularity=SERVICE_MONITOR__MINUTE, period_start=now.replace(second=0, microsecond=0))
+        self.assertEqual(minute.valid_response_count, 2)
+        self.assertEqual((minute.latency_min_ms, minute.latency_max_ms, minute.latency_mean_ms()), (100, 300, 200))
+        self.assertEqual(PingLogRollup.objects.filter(service=service, granularity=SERVICE_MONITOR__MINUTE).count(), 2)
+        daily = PingLogRollup.objects.get(service=service, granularity=SERVICE_MONITOR__DAILY)
+        self.assertEqual((daily.valid_response_count, daily.no_response_count), (2, 1))
+
+    def test_failed_flush_is_kept(self):
+        service = create_service()
+        now = datetime.datetime.now()
+        writer = PingLogWriter()
+        writer.log(service, now, ping_state=SERVICE_MONITOR__REQUEST_SENT)
+        service.ping_state = SERVICE_MONITOR__REQUEST_SENT
+        writer.save(service, "ping_state")
+        def fail(*args):
+            # Anything buffered while the write is failing is kept after what it failed to write
+            writer.log(service, now, ping_state=SERVICE_MONITOR__NO_RESPONSE)
+            service.ping_state = SERVICE_MONITOR__NO_RESPONSE
+            writer.save(service, "ping_state")
+            raise RuntimeError("write failed")
+        write = writer_module.write
+        writer_module.write = fail
+        try:
+            self.assertRaises(RuntimeError, writer.flush)
+        finally:
+            writer_module.write = write
+        self.assertEqual([entry.ping_state for entry, latency_ms in writer.entries], [SERVICE_MONITOR__REQUEST_SENT, SERVICE_MONITOR__NO_RESPONSE])
+        writer.flush()
+        self.assertEqual(PingLog.objects.filter(service=service).count(), 2)
+        self.assertEqual(Service.objects.get(pk=service.pk).ping_state, SERVICE_MONITOR__NO_RESPONSE)
+
+    def test_writes_of_deleted_services_are_dropped(self):
+        service = create_service()
+        deleted = create_service()
+        now = datetime.datetime.now()
+        writer = PingLogWriter()
+        for logged in (service, deleted):
+            writer.log(logged, now, ping_state=SERVICE_MONITOR__REQUEST_SENT)
+            logged.ping_state = SERVICE_MONITOR__REQUEST_SENT
+            writer.save(logged, "ping_state")
+        Service.objects.filter(pk=deleted.pk).delete()
+        def write_checking_services(entries, updates, rollup_entries=()):
+            # Like the foreign key checks of databases which enforce them
+            if Service.objects.filter(pk__in=[entry.service_id for entry, latency_ms in entries]).count() < len(entries):
+                raise IntegrityError("service does not exist")
+            return write(entries, updates, rollup_entries)
+        write = writer_module.write
+        writer_module.write = write_checking_services
+        try:
+            self.assertRaises(IntegrityError, writer.flush)
+            writer.flush()
+        finally:
+            writer_module.write = write
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(PingLog.objects.filter(service=service).count(), 1)
+        self.assertEqual(Service.objects.get(pk=service.pk).ping_state, SERVICE_MONITOR__REQUEST_SENT)
+
+class PruneTest(TestCase):
+    def test_prune_in_batches(self):
+        service = create_service()
+        now = datetime.datetime.now()
+        old = now - datetime.timedelta(days=400)
+        # The entries were counted in the rollups as they were written
+        PingLogRollupStart.objects.create(date=old)
+        for i in range(5):
+            PingLog.objects.create(service=service, date=old, ping_state=SERVICE_MONITOR__REQUEST_SENT)
+        recent = PingLog.objects.create(service=service, date=now, ping_state=SERVICE_MONITOR__REQUEST_SENT)
+        for granularity in (SERVICE_MONITOR__MINUTE, SERVICE_MONITOR__HOURLY, SERVICE_MONITOR__DAILY):
+            for i in range(3):
+                PingLogRollup.objects.create(service=service, granularity=granularity, period_start=old + datetime.timedelta(minutes=i))
+            PingLogRollup.objects.create(service=service, granularity=granularity, period_start=now)
+        self.assertEqual(prune_pinglog(batch_size=2, max_batches=2), 4)
+        self.assertEqual(prune_pinglog(batch_size=2), 1)
+        self.assertEqual([entry.pk for entry in PingLog.objects.all()], [recent.pk])
+        self.assertEqual(PingLogRollup.objects.filter(granularity=SERVICE_MONITOR__MINUTE).count(), 1)
+        self.assertEqual(PingLogRollup.objects.filter(granularity=SERVICE_MONITOR__HOURLY).count(), 1)
+        # Daily rollups are kept forever
+        self.assertEqual(PingLogRollup.objects.filter(granularity=SERVICE_MONITOR__DAILY).count(), 4)
+
+    def test_uncounted_entries_are_rolled_up(self):
+        service = create_service()
+        now = datetime.datetime.now()
+        old = now - datetime.timedelta(days=400)
+        PingLog.objects.create(service=service, date=old, ping_state=SERVICE_MONITOR__VALID_RESPONSE_RECEIVED, total_ms=200)
+        PingLog.objects.create(service=service, date=old, ping_state=SERVICE_MONITOR__NO_RESPONSE)
+        # Entries counted as they were written are not counted again
+        writer = PingLogWriter()
+        writer.log(service, now - datetime.timedelta(days=40), ping_state=SERVICE_MONITOR__NO_RESPONSE)
+        writer.flush()
+        self.assertEqual(prune_pinglog(), 3)
+        daily = PingLogRollup.objects.get(service=service, granularity=SERVICE_MONITOR__DAILY, period_start=old.replace(hour=0, minute=0, second=0, microsecond=0))
+        self.assertEqual((daily.valid_response_count, daily.no_response_count, daily.latency_max_ms), (1, 1, 200))
+        self.assertEqual(sum([rollup.no_response_count for rollup in PingLogRollup.objects.filter(granularity=SERVICE_MONITOR__DAILY)]), 2)
+
+class CircuitBreakerTest(TestCase):
+    def test_transitions(self):
+        breaker = CircuitBreaker(failures=2, backoff_seconds=10, max_backoff_seconds=25)
+        breaker.record("host", False, now=1000)
+        self.assertTrue(breaker.allow("host", now=1000))
+        breaker.record("host", False, now=1000)
+        self.assertTrue(breaker.is_open("host"))
+        self.assertFalse(breaker.allow("host", now=1005))
+        # A single trial is let through once the backoff has passed
+        self.assertTrue(breaker.allow("host", now=1010))
+        self.assertFalse(breaker.allow("host", now=1010))
+        breaker.record("host", False, now=1010)
+        self.assertFalse(breaker.allow("host", now=1029))
+        self.assertTrue(breaker.allow("host", now=1030))
+        breaker.record("host", False, now=1030)
+        # The backoff doubles up to the maximum
+        self.assertFalse(breaker.allow("host", now=1054))
+        self.assertTrue(breaker.allow("host", now=1055))
+        breaker.record("host", True, now=1055)
+        self.assertFalse(breaker.is_open("host"))
+        self.assertTrue(breaker.allow("host", now=1055))
+
+class AlertTrackerTest(TestCase):
+    def test_transitions(self):
+        service = Service(pk=1, ping_state=SERVICE_MONITOR__VALID_RESPONSE_RECEIVED)
+        tracker = AlertTracker()
+        tracker.seed(service)
+        now = datetime.datetime(2012, 1, 1)
+        self.assertEqual(tracker.observe(service, True, now), None)
+        self.assertEqual(tracker.observe(service, False, now), None)
+        self.assertEqual(tracker.observe(service, True, now), ALERT)
+        self.assertTrue(tracker.is_alerting(service))
+        self.assertEqual(tracker.observe(service, True, now + datetime.timedelta(minutes=59)), None)
+        self.assertEqual(tracker.observe(service, True, now + datetime.timedelta(minutes=60)), REALERT)
+        self.assertEqual(tracker.observe(service, False, now), None)
+        self.assertEqual(tracker.observe(service, False, now), RECOVERED)
+        self.assertFalse(tracker.is_alerting(service))
+
+    def test_seeded_failing_service_is_not_alerted_again(self):
+        service = Service(pk=1, ping_state=SERVICE_MONITOR__NO_RESPONSE)
+        tracker = AlertTracker()
+        tracker.seed(service)
+        self.assertTrue(tracker.is_alerting(service))
+        self.assertEqual(tracker.observe(service, True), None)
+        self.assertEqual(tracker.observe(service, True), None)
+
+class DeadlineTest(TestCase):
+    def test_timeout(self):
+        deadline = Deadline(10)
+        self.assertFalse(deadline.expired())
+        self.assertEqual(deadline.timeout(2), 2)
+        self.assertTrue(9 < deadline.timeout(30) <= 10)
+        deadline = Deadline(0)
+        self.assertTrue(deadline.expired())
+        self.assertRaises(socket.timeout, deadline.timeout, 2)
+    
+    def test_watch(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        sock = socket.create_connection(server.getsockname())
+        try:
+            # A read which would otherwise block for its whole timeout ends when the deadline passes
+            started = time.time()
+            timer = Deadline(0.2).watch(sock)
+            sock.settimeout(5)
+            self.assertEqual(sock.recv(1), "")
+            timer.cancel()
+            self.assertTrue(time.time() - started < 2)
+        finally:
+            sock.close()
+            server.close()
+
+class LatencyTrackerTest(TestCase):
+    def test_transitions(self):
+        tracker = LatencyTracker()
+        service = Service(pk=1, latency_slo_ms=100, latency_slo_percentile=50, latency_slo_window=3)
+        tracker.seed(service)
+        # The service stays as it was until the window is full
+        self.assertEqual(tracker.observe(service, 500), (False, False))
+        self.assertEqual(tracker.observe(service, 500), (False, False))
+        self.assertEqual(tracker.observe(service, 50), (False, True))
+        self.assertEqual(tracker.percentile(service), 500)
+        # The median falls back within the limit once a slow response leaves the window
+        self.assertEqual(tracker.observe(service, 50), (True, False))
+        self.assertEqual(tracker.percentile(service), 50)
+    
+    def test_seeded_degraded_service_stays_degraded(self):
+        tracker = LatencyTracker()
+        service = Service(pk=1, latency_slo_ms=100, latency_slo_percentile=95, latency_slo_window=2, ping_state=SERVICE_MONITOR__DEGRADED)
+        tracker.seed(service)
+        self.assertEqual(tracker.observe(service, 50), (True, True))
+        self.assertEqual(tracker.observe(service, 50), (True, False))
+    
+    def test_window_follows_the_service(self):
+        tracker = LatencyTracker()
+        service = Service(pk=1, latency_slo_ms=100, latency_slo_percentile=100, latency_slo_window=4)
+        for latency_ms in (500, 50, 50):
+            tracker.observe(service, latency_ms)
+        # A smaller window keeps the latest responses
+        service.latency_slo_window = 2
+        self.assertEqual(tracker.observe(service, 60), (False, False))
+        self.assertEqual(tracker.percentile(service), 60)
+        # Without a latency limit, the service is never degraded
+        service.latency_slo_ms = None
+        self.assertEqual(tracker.observe(service, 500), (False, False))
+
+class TokenBucketTest(TestCase):
+    def test_take(self):
+        bucket = TokenBucket(rate=0.5, capacity=2)
+        now = bucket.updated
+        self.assertEqual(bucket.take(now), 0)
+        self.assertEqual(bucket.take(now), 0)
+        self.assertAlmostEqual(bucket.take(now), 2.0)
+        self.assertAlmostEqual(bucket.take(now + 1), 1.0)
+        self.assertEqual(bucket.take(now + 2), 0)
+
+class SmsOutboxTest(TestCase):
+    def setUp(self):
+        # Nothing is handed off during the test, since the outbox thread is taken to be this one
+        self.outbox = tasks.outbox
+        tasks.outbox = SmsOutbox()
+        tasks.outbox.thread = threading.currentThread()
+
+    def tearDown(self):
+        tasks.outbox = self.outbox
+
+    def create_sms_service(self, **kwargs):
+        connection = Connection.objects.create(backend=Backend.objects.create(name="test"), identity="5551234")
+        return create_service(service_type=SERVICE_MONITOR__SMS, url=None, connection=connection, sms_to_send="ping {token}", **kwargs)
+
+    def test_request_state_is_written_at_hand_off(self):
+        service = self.create_sms_service()
+        tasks.run_leased(list(Service.objects.lease([service.pk])))
+        queued = Service.objects.get(pk=service.pk)
+        self.assertEqual((queued.ping_state, queued.timeout_at), (SERVICE_MONITOR__REQUEST_QUEUED, None))
+        self.assertTrue(service.pk in tasks.outbox)
+        self.assertEqual(PingLog.objects.count(), 0)
+        # A ping due while the request is still queued does not queue another one
+        tasks.run_leased(list(Service.objects.lease([service.pk])))
+        self.assertEqual(len(tasks.outbox), 1)
+
+        now = datetime.datetime.now()
+        tasks.outbox.hand_off(tasks.outbox.queued[service.pk], now)
+        sent = Service.objects.get(pk=service.pk)
+        self.assertEqual(sent.ping_state, SERVICE_MONITOR__REQUEST_SENT)
+        self.assertEqual(sent.timeout_at, now + datetime.timedelta(minutes=1))
+        self.assertEqual(sent.lease_owner, None)
+        self.assertEqual(PingLog.objects.get(service=service).ping_state, SERVICE_MONITOR__REQUEST_SENT)
+
+    def test_requeue(self):
+        service = self.create_sms_service(ping_state=SERVICE_MONITOR__REQUEST_QUEUED, last_request_date=datetime.datetime.now())
+        tasks.requeue()
+        self.assertTrue(service.pk in tasks.outbox)
+        self.assertNotEqual(Service.objects.get(pk=service.pk).lease_owner, None)
+
+    def test_stale_requests_are_not_requeued(self):
+        service = self.create_sms_service(ping_state=SERVICE_MONITOR__REQUEST_QUEUED, last_request_date=datetime.datetime.now() - datetime.timedelta(hours=1))
+        tasks.requeue()
+        self.assertFalse(service.pk in tasks.outbox)
+        self.assertEqual(Service.objects.get(pk=service.pk).lease_owner, None)
+
+class ServiceIndexTest(TestCase):
+    def create_sms_service(self, identity="5551234", **kwargs):
+        connection, created = Connection.objects.get_or_create(backend=Backend.objects.get_or_create(name="test")[0], identity=identity)
+        return create_service(service_type=SERVICE_MONITOR__SMS, url=None, connection=connection, sms_to_send="ping {token}", **kwargs)
+    
+    def test_match(self):
+        service = self.create_sms_service(valid_response_regex=r"^pong")
+        index = ServiceIndex()
+        descriptor = index.match("5551234", "pong")
+        self.assertEqual(descriptor.service().pk, service.pk)
+        self.assertTrue(descriptor.regex.match("pong"))
+        self.assertFalse(descriptor.regex.match("nope"))
+        self.assertRaises(Service.DoesNotExist, index.match, "5550000", "pong")
+        # Services added by other processes since the index was loaded are looked up in the database
+        other = self.create_sms_service(identity="5554321")
+        self.assertEqual(index.match("5554321", "anything").service().pk, other.pk)
+        self.assertTrue(index.match("5554321", "anything").regex.match("anything"))
+    
+    def test_match_by_token(self):
+        first = self.create_sms_service(ping_state=SERVICE_MONITOR__REQUEST_SENT, request_token="ab12c")
+        second = self.create_sms_service(ping_state=SERVICE_MONITOR__REQUEST_SENT, request_token="de34f")
+        index = ServiceIndex()
+        self.assertEqual(index.match("5551234", "PONG DE34F").service().pk, second.pk)
+        self.assertEqual(index.match("5551234", "ab12c pong").service().pk, first.pk)
+        # Without a token, a reply cannot be told apart while both are awaiting a response
+        self.assertRaises(Service.DoesNotExist, index.match, "5551234", "pong")
+        self.assertRaises(Service.DoesNotExist, index.match, "5551234", "pong zz99z")
+        second.ping_state = SERVICE_MONITOR__VALID_RESPONSE_RECEIVED
+        second.request_token = None
+        index.update(second)
+        self.assertEqual(index.match("5551234", "pong").service().pk, first.pk)
+        # The token of a request which was answered no longer matches
+        self.assertEqual(index.match("5551234", "pong de34f").service().pk, first.pk)
+
+class CatchUpTest(TestCase):
+    def test_outstanding_requests_keep_their_timeouts(self):
+        now = datetime.datetime.now().replace(microsecond=0)
+        service = create_service(service_type=SERVICE_MONITOR__SMS, ping_state=SERVICE_MONITOR__REQUEST_SENT, last_request_date=now - datetime.timedelta(seconds=150), ping_interval_seconds=60, timeout_minutes=10)
+        # The service has missed pings, but its request is still awaiting a response
+        self.assertEqual(list(Service.objects.due(now)), [service])
+        tasks.catch_up("skip")
+        saved = Service.objects.get(pk=service.pk)
+        self.assertEqual((saved.last_request_date, saved.timeout_at), (service.last_request_date, service.timeout_at))
+
+    def test_timed_out_requests_are_recorded_before_catching_up(self):
+        now = datetime.datetime.now()
+        service = create_service(service_type=SERVICE_MONITOR__SMS, ping_state=SERVICE_MONITOR__REQUEST_SENT, last_request_date=now - datetime.timedelta(hours=3))
+        tasks.catch_up("skip")
+        saved = Service.objects.get(pk=service.pk)
+        self.assertEqual((saved.ping_state, saved.timeout_at), (SERVICE_MONITOR__NO_RESPONSE, None))
+        self.assertEqual(PingLog.objects.get(service=service).ping_state, SERVICE_MONITOR__NO_RESPONSE)
+        self.assertTrue(saved.next_ping_at > now)
+
+class ProbeLoopTest(TestCase):
+    def test_services_probed_in_the_background_are_left_alone(self):
+        service = create_service()
+        tasks.probes_in_flight.add(service.pk)
+        try:
+            self.assertEqual(tasks.run_leased(list(Service.objects.lease([service.pk])), wait=False), [])
+        finally:
+            tasks.probes_in_flight.discard(service.pk)
+        self.assertEqual(Service.objects.get(pk=service.pk).ping_state, None)
+    
+    def test_probes_longer_than_the_interval_do_not_spin_the_loop(self):
+        service = create_service(ping_interval_seconds=5)
+        service.last_request_date = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(seconds=10)
+        service.ping_state = SERVICE_MONITOR__REQUEST_SENT
+        service.save()
+        Service.objects.lease([service.pk])
+        tasks.probes_in_flight.add(service.pk)
+        try:
+            tasks.schedule.invalidate()
+            self.assertEqual(tasks.schedule.seconds_until_due(), 0)
+            tasks.run_due(wait=False)
+            self.assertEqual(tasks.schedule.seconds_until_due(), None)
+        finally:
+            tasks.probes_in_flight.discard(service.pk)
+        # The lease of the probe in flight is kept until its results are written
+        self.assertNotEqual(Service.objects.get(pk=service.pk).lease_owner, None)
+
+"""
+Handles the requests of the TestHTTPServer: each path answers in the
+way the probe tests need.
+"""
+class TestHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.respond()
+    
+    def do_HEAD(self):
+        self.respond()
+    
+    def respond(self):
+        self.server.requests.append((self.command, self.path))
+        # The query string only tells probes of the same path apart
+        path = self.path.split("?")[0]
+        try:
+            if path == "/":
+                self.send_body(200, "service is up")
+            elif path == "/error":
+                self.send_body(500, "service is down")
+            elif path == "/redirect":
+                self.send_response(302)
+                self.send_header("Location", "/")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            elif path == "/big":
+                self.send_body(200, "x" * 100000)
+            elif path == "/trickle":
+                # Each byte comes well within the read timeout, but the whole body takes 5 seconds
+                self.send_response(200)
+                self.send_header("Content-Length", "50")
+                self.end_headers()
+                for i in range(50):
+                    self.wfile.write("x")
+                    self.wfile.flush()
+                    time.sleep(0.1)
+        except socket.error:
+            # The probe hung up without reading the whole response
+            pass
+    
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+"""
+A local HTTP server for the probe tests, serving each request from a
+thread of its own. It records the method and path of every request.
+"""
+class TestHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), TestHTTPRequestHandler)
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    
+    def url(self, path):
+        return "http://127.0.0.1:%s%s" % (self.server_address[1], path)
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+"""
+Returns the url of a local port nothing listens on.
+"""
+def refused_url():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "http://127.0.0.1:%s/" % port
+
+def probe_service(**kwargs):
+    values = {
+        "name": "Test"
+       ,"service_type": SERVICE_MONITOR__HTTP
+       ,"timeout_seconds": 2
+    }
+    values.update(kwargs)
+    return Service(**values)
+
+"""
+A ProbeEngine whose probes only sleep, and which records the largest
+number of probes it had in flight at once, in total and per host.
+"""
+class SleepingProbeEngine(ProbeEngine):
+    def __init__(self, **kwargs):
+        ProbeEngine.__init__(self, **kwargs)
+        self.lock = threading.Lock()
+        self.probing = {}
+        self.max_probing = {}
+    
+    def probe_one(self, service):
+        host = service.url
+        self.lock.acquire()
+        try:
+            self.probing[host] = self.probing.get(host, 0) + 1
+            self.probing[None] = self.probing.get(None, 0) + 1
+            for key in (host, None):
+                self.max_probing[key] = max(self.max_probing.get(key, 0), self.probing[key])
+        finally:
+            self.lock.release()
+        time.sleep(0.02)
+        self.lock.acquire()
+        try:
+            self.probing[host] -= 1
+            self.probing[None] -= 1
+        finally:
+            self.lock.release()
+        return ProbeResult(service)
+
+class ProbeEngineTest(TestCase):
+    def setUp(self):
+        self.server = TestHTTPServer()
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def test_probe(self):
+        engine = ProbeEngine(pool=ConnectionPool(), breaker=CircuitBreaker())
+        services = [probe_service(url=self.server.url("/")), probe_service(url=self.server.url("/error")), probe_service(url=self.server.url("/redirect")), probe_service(url=refused_url())]
+        up, error, redirect, refused = engine.probe(services)
+        self.assertEqual([result.service for result in (up, error, redirect, refused)], services)
+        self.assertTrue(up.succeeded())
+        self.assertEqual((up.status_code, up.body_bytes), (200, 13))
+        self.assertTrue(up.total_ms >= up.ttfb_ms >= 0)
+        self.assertTrue(isinstance(error.error, urllib2.HTTPError) and not error.unreachable())
+        self.assertEqual((error.error.code, error.status_code), (500, 500))
+        self.assertTrue(redirect.succeeded())
+        # The redirect was followed to the same path as the first service
+        self.assertEqual(self.server.requests.count(("GET", "/")), 2)
+        self.assertTrue(refused.unreachable())
+        self.assertEqual(refused.status_code, None)
+    
+    def test_probe_modes(self):
+        engine = ProbeEngine(pool=ConnectionPool(), breaker=CircuitBreaker())
+        services = [
+            probe_service(url=self.server.url("/"), http_method=SERVICE_MONITOR__HEAD)
+           ,probe_service(url=self.server.url("/big"), max_body_bytes=10)
+           ,probe_service(url=self.server.url("/"), valid_body_regex=r"is up$")
+           ,probe_service(url=self.server.url("/"), valid_body_regex=r"is down")
+        ]
+        head, capped, valid, invalid = engine.probe(services)
+        self.assertTrue(head.succeeded())
+        self.assertEqual((head.status_code, head.body_bytes), (200, 0))
+        self.assertEqual(self.server.requests.count(("HEAD", "/")), 1)
+        self.assertTrue(capped.succeeded())
+        self.assertEqual(capped.body_bytes, 10)
+        self.assertTrue(valid.succeeded())
+        self.assertTrue(invalid.invalid() and not invalid.unreachable())
+        self.assertEqual(invalid.body_bytes, 13)
+    
+    def test_deadline(self):
+        engine = ProbeEngine(pool=ConnectionPool(), breaker=CircuitBreaker())
+        started = time.time()
+        result = engine.probe([probe_service(url=self.server.url("/trickle"), timeout_seconds=1, read_timeout_seconds=1)])[0]
+        self.assertTrue(time.time() - started < 3)
+        self.assertTrue(result.unreachable())
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.total_ms >= 1000)
+    
+    def test_caps(self):
+        engine = SleepingProbeEngine(max_concurrent=3, max_per_host=2)
+        results = engine.probe([Service(pk=i, url="http://%s.example.com/" % (i % 2)) for i in range(12)])
+        self.assertEqual([result.service.pk for result in results], range(12))
+        self.assertEqual(engine.max_probing[None], 3)
+        self.assertEqual((engine.max_probing["http://0.example.com/"], engine.max_probing["http://1.example.com/"]), (2, 2))
+    
+    def test_caps_hold_across_batches(self):
+        engine = SleepingProbeEngine(max_concurrent=3, max_per_host=2)
+        batches = [[Service(pk=i, url="http://%s.example.com/" % (i % 2)) for i in range(batch * 6, batch * 6 + 6)] for batch in range(3)]
+        results = []
+        threads = [threading.Thread(target=lambda batch=batch: results.extend(engine.probe(batch))) for batch in batches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 18)
+        self.assertEqual(engine.max_probing[None], 3)
+        self.assertEqual(max([engine.max_probing[batch[0].url] for batch in batches]), 2)
+        self.assertEqual((engine.running, engine.in_flight), (0, {}))
+
+class AsyncProbeEngineTest(TestCase):
+    def setUp(self):
+        self.server = TestHTTPServer()
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    """
+    Runs the event loop of the given engine until all of its probes have
+    finished, and returns their results by url.
+    """
+    def poll_all(self, engine):
+        results = {}
+        started = time.time()
+        while True:
+            for result in engine.poll(0.05):
+                results[result.service.url] = result
+            if not len(engine) or time.time() - started > 10:
+                break
+        self.assertEqual(len(engine), 0)
+        return results
+    
+    def test_probe(self):
+        engine = AsyncProbeEngine(breaker=CircuitBreaker())
+        for path in ("/", "/error", "/redirect"):
+            engine.start(probe_service(url=self.server.url(path)))
+        refused = refused_url()
+        engine.start(probe_service(url=refused))
+        engine.start(probe_service(url=self.server.url("/?head"), http_method=SERVICE_MONITOR__HEAD))
+        engine.start(probe_service(url=self.server.url("/?regex"), valid_body_regex="down"))
+        results = self.poll_all(engine)
+        up = results[self.server.url("/")]
+        self.assertTrue(up.succeeded())
+        self.assertEqual((up.status_code, up.body_bytes), (200, 13))
+        self.assertTrue(up.total_ms >= up.ttfb_ms >= 0)
+        error = results[self.server.url("/error")]
+        self.assertEqual(error.error.code, 500)
+        self.assertFalse(error.unreachable())
+        self.assertTrue(results[self.server.url("/redirect")].succeeded())
+        self.assertTrue(results[refused].unreachable())
+        head = results[self.server.url("/?head")]
+        self.assertTrue(head.succeeded())
+        self.assertEqual(head.body_bytes, 0)
+        self.assertTrue(("HEAD", "/?head") in self.server.requests)
+        self.assertTrue(results[self.server.url("/?regex")].invalid())
+    
+    def test_per_host_cap(self):
+        engine = AsyncProbeEngine(max_per_host=1, breaker=CircuitBreaker())
+        for i in range(3):
+            engine.start(probe_service(url=self.server.url("/?%s" % i)))
+        self.assertEqual((len(engine.probes), len(engine.waiting)), (1, 2))
+        results = self.poll_all(engine)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all([result.succeeded() for result in results.values()]))
+    
+    def test_deadline(self):
+        engine = AsyncProbeEngine(breaker=CircuitBreaker())
+        engine.start(probe_service(url=self.server.url("/trickle"), timeout_seconds=1, read_timeout_seconds=1))
+        started = time.time()
+        result = self.poll_all(engine).values()[0]
+        self.assertTrue(time.time() - started < 3)
+        self.assertTrue(result.unreachable())
+    
+    def test_circuit_breaker(self):
+        url = refused_url()
+        engine = AsyncProbeEngine(breaker=CircuitBreaker(failures=1))
+        engine.start(probe_service(url=url))
+        self.assertTrue(self.poll_all(engine)[url].unreachable())
+        engine.start(probe_service(url=url))
+        self.assertTrue(isinstance(self.poll_all(engine)[url].error, CircuitOpenError))
+    
+    def test_resolver_cache(self):
+        lookups = []
+        def getaddrinfo(host, *args):
+            lookups.append(host)
+            if host == "unknown.invalid":
+                raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", args[0]))]
+        resolver = ResolverCache()
+        original = asyncprobe.socket.getaddrinfo
+        asyncprobe.socket.getaddrinfo = getaddrinfo
+        try:
+            for i in range(3):
+                self.assertEqual(resolver.resolve("localhost", 80), (socket.AF_INET, ("127.0.0.1", 80)))
+                self.assertRaises(socket.gaierror, resolver.resolve, "unknown.invalid", 80)
+        finally:
+            asyncprobe.socket.getaddrinfo = original
+        self.assertEqual(lookups, ["localhost", "unknown.invalid"])
+
+class ProbeDaemonTest(TestCase):
+    def setUp(self):
+        self.server = TestHTTPServer()
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def test_probe_due_services(self):
+        up = create_service(url=self.server.url("/"))
+        down = create_service(url=self.server.url("/error"), email_list="")
+        create_service(service_type=SERVICE_MONITOR__SMS, url=None)
+        daemon = ProbeDaemon(engine=AsyncProbeEngine(breaker=CircuitBreaker()), result_writer=PingLogWriter())
+        daemon.start_due()
+        self.assertEqual(daemon.in_flight, set([up.pk, down.pk]))
+        # Services being probed are not started again
+        daemon.schedule.invalidate()
+        daemon.start_due()
+        self.assertEqual(len(daemon.engine), 2)
+        started = time.time()
+        while len(daemon.engine) and time.time() - started < 10:
+            daemon.record(daemon.engine.poll(0.05))
+        daemon.flush()
+        self.assertEqual(daemon.in_flight, set())
+        up, down = Service.objects.get(pk=up.pk), Service.objects.get(pk=down.pk)
+        self.assertEqual((up.ping_state, up.lease_owner), (SERVICE_MONITOR__VALID_RESPONSE_RECEIVED, None))
+        self.assertEqual((down.ping_state, down.lease_owner), (SERVICE_MONITOR__NO_RESPONSE, None))
+        self.assertEqual(list(PingLog.objects.filter(service=up).order_by("id").values_list("ping_state", "status_code")), [(SERVICE_MONITOR__REQUEST_SENT, None), (SERVICE_MONITOR__VALID_RESPONSE_RECEIVED, 200)])
+
+class ServiceConfigCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_version_bumps(self):
+        service = create_service()
+        config = ServiceConfigCache()
+        version = config.current_version()
+        config.get()
+        # State changes leave the version alone
+        service.ping_state = SERVICE_MONITOR__REQUEST_SENT
+        config.update(service)
+        self.assertEqual(config.current_version(), version)
+        # Configuration changes bump it
+        service.url = "http://example.org/"
+        config.update(service)
+        self.assertNotEqual(config.current_version(), version)
+
+    def test_check_picks_up_bumps_from_other_processes(self):
+        service = create_service()
+        config = ServiceConfigCache()
+        other = ServiceConfigCache()
+        self.assertEqual(config.get()["configs"].keys(), [service.pk])
+        Service.objects.filter(pk=service.pk).update(active=False)
+        other.bump()
+        self.assertEqual(config.get()["configs"].keys(), [service.pk])
+        config.check()
+        self.assertEqual(config.get()["configs"].keys(), [])
+    
+    def test_snapshot_is_shared_in_chunks(self):
+        services = [create_service(url="http://%s.example.com/" % i) for i in range(5)]
+        config = ServiceConfigCache(chunk_size=2)
+        snapshot = config.get()
+        self.assertEqual(cache.get(SNAPSHOT_KEY % config.version), 3)
+        # Another process loads the same snapshot from the cache rather than the database
+        Service.objects.filter(pk=services[0].pk).update(active=False)
+        other = ServiceConfigCache(chunk_size=2)
+        self.assertEqual(other.get(), snapshot)
+        self.assertEqual(len(other.get()["configs"]), 5)
+        # A chunk evicted from the cache makes it load a new one
+        cache.delete(CHUNK_KEY % (config.version, 1))
+        self.assertEqual(len(ServiceConfigCache(chunk_size=2).get()["configs"]), 4)
+
+class FailingEmailBackend(EmailBackend):
+    # The number of emails sent before the mail server fails
+    limit = 1
+
+    def send_messages(self, messages):
+        if len(mail.outbox) + len(messages) > self.limit:
+            raise IOError("Connection reset")
+        for message in messages:
+            if "refused@example.com" in message.to:
+                raise smtplib.SMTPRecipientsRefused({"refused@example.com": (550, "No such user")})
+        return super(FailingEmailBackend, self).send_messages(messages)
+
+class NotificationQueueTest(TestCase):
+    def setUp(self):
+        self.get_connection = notify.get_connection
+        notify.get_connection = FailingEmailBackend
+
+    def tearDown(self):
+        notify.get_connection = self.get_connection
+
+    def test_only_unsent_emails_are_queued_again(self):
+        queue = NotificationQueue()
+        now = datetime.datetime.now()
+        due = [("a@example.com", [(now, "a", "a")]), ("b@example.com", [(now, "b1", "b1"), (now, "b2", "b2")])]
+        self.assertFalse(queue.deliver(due))
+        self.assertEqual([message.to for message in mail.outbox], [["a@example.com"]])
+        self.assertEqual(queue.pending, {"b@example.com": due[1][1]})
+    
+    def test_rejected_emails_are_dropped(self):
+        queue = NotificationQueue()
+        now = datetime.datetime.now()
+        due = [("refused@example.com", [(now, "a", "a")]), ("b@example.com", [(now, "b", "b")])]
+        self.assertTrue(queue.deliver(due))
+        self.assertEqual([message.to for message in mail.outbox], [["b@example.com"]])
+        self.assertEqual(queue.pending, {})
@@ -0,0 +1,271 @@
+import datetime
+import logging
+import operator
+import threading
+
+from .models import *
+from django.db import connection, models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.conf import settings
+
+# The number of buffered PingLog entries and Service updates which
+# triggers a flush
+SERVICE_MONITOR_WRITE_BUFFER_SIZE = getattr(settings, "SERVICE_MONITOR_WRITE_BUFFER_SIZE", 500)
+
+# The maximum number of seconds writes from the SMS handler are held
+# in the buffer before being flushed
+SERVICE_MONITOR_WRITE_BUFFER_SECONDS = getattr(settings, "SERVICE_MONITOR_WRITE_BUFFER_SECONDS", 5)
+
+logger = logging.getLogger("monitor.writer")
+
+"""
+A write-behind buffer for PingLog entries and Service state changes.
+Instead of saving each PingLog and Service as they change, callers
+log entries and record the changed fields here, and flush() writes
+everything as one bulk insert plus one batched update per set of
+changed fields, inside a single transaction. The PingLogRollups of
+the logged entries are updated in the same transaction.
+
+Once the transaction is committed, post_save is sent for each updated
+Service so that anything listening (such as the schedule) sees the
+change just as if the service had been saved.
+"""
+class PingLogWriter(object):
+    def __init__(self, flush_size=None, flush_seconds=None):
+        self.flush_size = flush_size or SERVICE_MONITOR_WRITE_BUFFER_SIZE
+        self.flush_seconds = flush_seconds or SERVICE_MONITOR_WRITE_BUFFER_SECONDS
+        self.lock = threading.RLock()
+        self.entries = []
+        self.rollup_entries = []
+        self.updates = {}
+        self.buffered_date = None
+
+    def __len__(self):
+        return len(self.entries) + len(self.rollup_entries) + len(self.updates)
+
+    """
+    Buffers a PingLog entry for the given service. The ping state
+    defaults to the service's current ping state. For responses, the
+    latency in milliseconds can be given to be counted in the rollups.
+    If rollup_only is true, the entry is only counted in the rollups
+    and never written to the PingLog itself.
+    """
+    def log(self, service, date, ping_state=None, latency_ms=None, rollup_only=False, **kwargs):
+        if ping_state is None:
+            ping_state = service.ping_state
+        entry = PingLog(service_id=service.pk, date=date, ping_state=ping_state, **kwargs)
+        self.lock.acquire()
+        try:
+            if rollup_only:
+                self.rollup_entries.append((entry, latency_ms))
+            else:
+                self.entries.append((entry, latency_ms))
+            self.touch()
+        finally:
+            self.lock.release()
+        return entry
+
+    """
+    Buffers an update of the given fields of the service, using their
+    current values. Changes to the request state also update the
+    derived next_ping_at and timeout_at fields.
+    """
+    def save(self, service, *field_names):
+        field_names = list(field_names)
+        if "last_request_date" in field_names or "ping_state" in field_names:
+            service.update_schedule()
+            field_names.append("timeout_at")
+            if "last_request_date" in field_names:
+                field_names.append("next_ping_at")
+        self.lock.acquire()
+        try:
+            values = self.updates.get(service.pk, (service, {}))[1]
+            for field_name in field_names:
+                values[field_name] = getattr(service, field_name)
+            self.updates[service.pk] = (service, values)
+            self.touch()
+        finally:
+            self.lock.release()
+
+    def touch(self):
+        if self.buffered_date is None:
+            self.buffered_date = datetime.datetime.now()
+        if len(self) >= self.flush_size:
+            self.flush()
+
+    """
+    Flushes the buffer if it has been holding writes for longer than
+    flush_seconds.
+    """
+    def flush_if_due(self):
+        buffered_date = self.buffered_date
+        if buffered_date is not None and datetime.datetime.now() - buffered_date >= datetime.timedelta(seconds=self.flush_seconds):
+            self.flush()
+
+    """
+    Writes all buffered entries and updates in a single transaction.
+    If the transaction fails, everything is put back in the buffer to
+    be written by the next flush, and the error is raised. Entries and
+    updates of services which no longer exist are dropped instead,
+    since they would fail every flush from then on.
+    """
+    def flush(self):
+        self.lock.acquire()
+        try:
+            entries, self.entries = self.entries, []
+            rollup_entries, self.rollup_entries = self.rollup_entries, []
+            updates, self.updates = self.updates, {}
+            buffered_date, self.buffered_date = self.buffered_date, None
+            if entries or rollup_entries or updates:
+                try:
+                    write(entries, updates.values(), rollup_entries)
+                except:
+                    entries, rollup_entries, updates = drop_deleted(entries, rollup_entries, updates)
+                    self.restore(entries, rollup_entries, updates, buffered_date)
+                    raise
+        finally:
+            self.lock.release()
+        for service, values in updates.values():
+            post_save.send(sender=Service, instance=service, created=False, raw=False, using=connection.alias)
+
+    """
+    Puts the given entries and updates, which failed to be written,
+    back in the buffer ahead of anything buffered since. Fields updated
+    since keep their newer values.
+    """
+    def restore(self, entries, rollup_entries, updates, buffered_date):
+        self.lock.acquire()
+        try:
+            self.entries = entries + self.entries
+            self.rollup_entries = rollup_entries + self.rollup_entries
+            for service_id, (service, values) in self.updates.items():
+                if service_id in updates:
+                    values = dict(updates[service_id][1], **values)
+                updates[service_id] = (service, values)
+            self.updates = updates
+            if buffered_date is not None:
+                self.buffered_date = buffered_date
+        finally:
+            self.lock.release()
+
+"""
+Returns the given entries, rollup entries and updates, which failed to
+be written, less those of services which no longer exist (e.g. services
+deleted in the admin while their writes were buffered). If the database
+cannot be reached, everything is returned.
+"""
+def drop_deleted(entries, rollup_entries, updates):
+    service_ids = set([entry.service_id for entry, latency_ms in entries + rollup_entries] + updates.keys())
+    try:
+        existing_ids = set(Service.objects.filter(pk__in=list(service_ids)).values_list("pk", flat=True))
+    except Exception:
+        return entries, rollup_entries, updates
+    deleted_ids = service_ids - existing_ids
+    if not deleted_ids:
+        return entries, rollup_entries, updates
+    logger.warning("Dropping the buffered writes of deleted services %s" % ", ".join([str(service_id) for service_id in sorted(deleted_ids)]))
+    entries = [(entry, latency_ms) for entry, latency_ms in entries if entry.service_id in existing_ids]
+    rollup_entries = [(entry, latency_ms) for entry, latency_ms in rollup_entries if entry.service_id in existing_ids]
+    updates = dict([(service_id, update) for service_id, update in updates.items() if service_id in existing_ids])
+    return entries, rollup_entries, updates
+
+def get_db_prep_save(field, instance):
+    return field.get_db_prep_save(field.pre_save(instance, True), connection=connection)
+
+"""
+Inserts the given unsaved instances of the model with a single
+executemany.
+"""
+def bulk_insert(model, instances):
+    if not instances:
+        return
+    qn = connection.ops.quote_name
+    fields = [field for field in model._meta.local_fields if not isinstance(field, models.AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table)
+       ,", ".join([qn(field.column) for field in fields])
+       ,", ".join(["%s"] * len(fields))
+    )
+    connection.cursor().executemany(sql, [[get_db_prep_save(field, instance) for field in fields] for instance in instances])
+
+"""
+Updates the given fields of the model from the given list of
+(pk, {field name: value}) with a single executemany.
+"""
+def bulk_update(model, field_names, rows):
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    fields = [model._meta.get_field(field_name) for field_name in field_names]
+    sql = "UPDATE %s SET %s WHERE %s = %%s" % (
+        qn(model._meta.db_table)
+       ,", ".join(["%s = %%s" % qn(field.column) for field in fields])
+       ,qn(model._meta.pk.column)
+    )
+    params = []
+    for pk, values in rows:
+        row = [field.get_db_prep_save(values[field.name], connection=connection) for field in fields]
+        row.append(pk)
+        params.append(row)
+    connection.cursor().executemany(sql, params)
+
+"""
+Counts the given list of (PingLog entry, latency) in the minute,
+hourly and daily PingLogRollups of their services, creating the
+rollups which do not exist yet.
+"""
+def update_rollups(entries):
+    rollups = {}
+    for entry, latency_ms in entries:
+        date = local_datetime(entry.date)
+        for granularity in (SERVICE_MONITOR__MINUTE, SERVICE_MONITOR__HOURLY, SERVICE_MONITOR__DAILY):
+            key = (entry.service_id, granularity, PingLogRollup.period_start_for(granularity, date))
+            if key not in rollups:
+                rollups[key] = PingLogRollup(service_id=key[0], granularity=key[1], period_start=key[2])
+            rollups[key].add(entry.ping_state, date, latency_ms)
+
+    # Merge into the rollups which already exist, looking up only the periods counted here
+    period_starts = {}
+    for service_id, granularity, period_start in rollups.keys():
+        period_starts.setdefault(granularity, set()).add(period_start)
+    periods = [Q(granularity=granularity, period_start__in=list(starts)) for granularity, starts in period_starts.items()]
+    existing_rollups = PingLogRollup.objects.filter(
+        reduce(operator.or_, periods)
+       ,service__in=list(set([key[0] for key in rollups.keys()]))
+    )
+    updated = []
+    for existing in existing_rollups:
+        rollup = rollups.pop((existing.service_id, existing.granularity, existing.period_start), None)
+        if rollup is not None:
+            existing.merge(rollup)
+            updated.append(existing)
+
+    bulk_insert(PingLogRollup, rollups.values())
+    field_names = [field.name for field in PingLogRollup._meta.local_fields if field.name not in ("id", "service", "granularity", "period_start")]
+    bulk_update(PingLogRollup, field_names, [(rollup.pk, dict([(field_name, getattr(rollup, field_name)) for field_name in field_names])) for rollup in updated])
+
+"""
+Bulk inserts the given list of (PingLog entry, latency), counts them
+and the given list of rollup_entries in the rollups, and applies the
+given list of (service, {field name: value}) updates, all in a single
+transaction.
+"""
+@transaction.commit_on_success
+def write(entries, updates, rollup_entries=()):
+    if entries:
+        bulk_insert(PingLog, [entry for entry, latency_ms in entries])
+    if entries or rollup_entries:
+        update_rollups(list(entries) + list(rollup_entries))
+
+    # Services which changed the same set of fields are updated together
+    batches = {}
+    for service, values in updates:
+        batches.setdefault(tuple(sorted(values.keys())), []).append((service.pk, values))
+    for field_names, rows in batches.items():
+        bulk_update(Service, field_names, rows)
+
+    transaction.set_dirty()
+
+# The buffer shared by everything running in this process
+writer = PingLogWriter()
@@ -12,6 +12,21 @@
 DATABASES = {}
 
 
+# the monitor processes (the router, the celery workers and the probe
+# daemon) share a snapshot of the service configuration through the
+# cache (see monitor/config.py), so it must be one they can all reach:
+# memcached, installed from requirements/apt-packages.txt. a monitor
+# running as a single process can use
+# "django.core.cache.backends.locmem.LocMemCache" instead.
+# see: https://docs.djangoproject.com/en/1.3/topics/cache/
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.memcached.MemcachedCache",
+        "LOCATION": "127.0.0.1:11211",
+    }
+}
+
+
 # the rapidsms backend configuration is designed to resemble django's
 # database configuration, as a nested dict of (name, configuration).
 #
@@ -64,6 +79,13 @@ INSTALLED_APPS = [
     "monitor"
 ]
 
+# celeryd and celerybeat load their tasks (see monitor/tasks.py) through
+# django-celery. set SERVICE_MONITOR_PROBE_DISPATCH = "celery" in your
+# localsettings to probe HTTP services from the celeryd workers instead
+# of the router.
+import djcelery
+djcelery.setup_loader()
+
 RAPIDSMS_HANDLERS_EXCLUDE_APPS = [
     "scheduler"
 ]